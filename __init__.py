@@ -6,7 +6,7 @@ from .lora_loader_elemental import LoraLoaderElemental
 from .random_word_replacer import RandomWordReplacer
 from .lora_weight_randomizer import LoraWeightRandomizer
 from .lora_mixer_elemental import LoraMixerElemental
-from .quantized_lora_loader import QuantizedLoraLoader
+from .quantized_lora_loader import QuantizedLoraLoader, QuantizedLoraBatchConverter
 from .lora_selector import LoraSelector
 from .text_file_selector import TextFileSelector
 from .Image_text_pair_sequence_loader import ImageTextPairSequenceLoader
@@ -28,6 +28,7 @@ NODE_CLASS_MAPPINGS = {
     "LoraWeightRandomizer": LoraWeightRandomizer,
     "LoraMixerElemental": LoraMixerElemental,
     "QuantizedLoraLoader": QuantizedLoraLoader,
+    "QuantizedLoraBatchConverter": QuantizedLoraBatchConverter,
     "LoraSelector": LoraSelector,
     "TextFileSelector": TextFileSelector,
     "ImageTextPairSequenceLoader": ImageTextPairSequenceLoader,
@@ -49,6 +50,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "LoraWeightRandomizer": "Lora Weight Randomizer",
     "LoraMixerElemental": "Lora Mixer Elemental",
     "QuantizedLoraLoader": "Quantized Lora Loader",
+    "QuantizedLoraBatchConverter": "Quantized Lora Batch Converter",
     "LoraSelector": "Lora Selector",
     "TextFileSelector": "Text File Selector",
     "ImageTextPairSequenceLoader": "Image TextPair SequenceLoader",
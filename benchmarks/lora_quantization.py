@@ -0,0 +1,93 @@
+# Run from the ComfyUI root: python custom_nodes/tksw_node/benchmarks/lora_quantization.py models/loras/a.safetensors ...
+import argparse
+import importlib
+import os
+import resource
+import subprocess
+import sys
+import time
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.getcwd(), os.path.dirname(PACKAGE_DIR)]
+
+import torch
+
+CASES = {
+    "iterations=1": (1, False),
+    "iterations=3": (3, False),
+    "stepwise (ss=2)": (1, True),
+}
+
+
+def reference_quantize_tensor(tensor, bits):
+    original_dtype = tensor.dtype
+    min_val = tensor.min()
+    max_val = tensor.max()
+    if max_val - min_val == 0:
+        return torch.zeros_like(tensor, dtype=original_dtype)
+    scale = (max_val - min_val) / (2**bits - 1)
+    zero_point = torch.round(-min_val / scale)
+    quantized_tensor = torch.clamp(torch.round(tensor / scale + zero_point), 0, 2**bits - 1)
+    return ((quantized_tensor - zero_point) * scale).to(original_dtype)
+
+
+def peak_rss_mib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def run_case(path, implementation, case, bits, granularity):
+    module = importlib.import_module(f"{os.path.basename(PACKAGE_DIR)}.quantized_lora_loader")
+    lora_utils = importlib.import_module(f"{os.path.basename(PACKAGE_DIR)}.lora_utils")
+    loader = module.QuantizedLoraLoader()
+    lora, _ = lora_utils.load_lora_state_dict(path)
+    keys = [key for key in lora if "lora_down" in key or "lora_up" in key]
+    original_bits = 32 if lora[keys[0]].dtype == torch.float32 else 16
+    iterations, stepwise = CASES[case]
+    bit_levels = loader._bit_levels(original_bits, bits, iterations, stepwise, 2)
+    if implementation == "before" and not stepwise:
+        bit_levels = [bits] * iterations
+
+    rss_before = peak_rss_mib()
+    start = time.perf_counter()
+    if implementation == "before":
+        quantized = {}
+        for key in keys:
+            tensor = lora[key]
+            for level in bit_levels:
+                tensor = reference_quantize_tensor(tensor, level)
+            quantized[key] = tensor
+    else:
+        quantized = loader._quantize_lora_tensors(lora, keys, bit_levels, granularity, 64)
+    elapsed = time.perf_counter() - start
+    print(f"{elapsed * 1000:.0f} {peak_rss_mib() - rss_before:.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("loras", nargs="+")
+    parser.add_argument("--bits", type=int, default=4)
+    parser.add_argument("--granularity", default="Per Tensor")
+    parser.add_argument("--run", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        run_case(args.loras[0], args.run[0], args.run[1], args.bits, args.granularity)
+        return
+
+    print(f"{'lora':<32} {'MB':>6} {'case':<16} {'before':>18} {'after':>18}")
+    for path in args.loras:
+        size_mb = os.path.getsize(path) / 1e6
+        for case in CASES:
+            results = []
+            for implementation in ("before", "after"):
+                # Each run gets its own process so the peak RSS is not shared between runs.
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), path, "--bits", str(args.bits),
+                                         "--granularity", args.granularity, "--run", implementation, case],
+                                        check=True, capture_output=True, text=True).stdout.split()
+                ms, mib = output[-2:]
+                results.append(f"{ms}ms / +{mib}MiB")
+            print(f"{os.path.basename(path)[:32]:<32} {size_mb:>6.0f} {case:<16} {results[0]:>18} {results[1]:>18}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# Run from the ComfyUI root: python custom_nodes/tksw_node/benchmarks/sigma_step_lookup.py
+import os
+import sys
+import timeit
+
+sys.path[:0] = [os.getcwd(), os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import torch
+from custom_cfg_schedule import SigmaStepLookup, find_sigma_index
+
+STEP_COUNTS = (20, 50, 200, 1000)
+REPEATS = 5
+
+
+def bench(steps):
+    sigmas = torch.linspace(14.6, 0.0, steps + 1)
+    sigmas_list = sigmas.tolist()
+    lookup = SigmaStepLookup(sigmas)
+    queries = [sigmas_list[i] for i in range(0, steps, max(1, steps // 16))] + [sigmas_list[-2] * 1.01]
+    number = max(1, 20000 // len(queries))
+
+    def run_lookup():
+        for sigma in queries:
+            lookup.index(sigma)
+
+    def run_linear():
+        for sigma in queries:
+            find_sigma_index(sigma, sigmas_list)
+
+    def run_linear_tensor():
+        for sigma in queries:
+            find_sigma_index(sigma, sigmas)
+
+    results = []
+    for fn in (run_lookup, run_linear, run_linear_tensor):
+        best = min(timeit.repeat(fn, number=number, repeat=REPEATS))
+        results.append(best / (number * len(queries)) * 1e6)
+    return results
+
+
+def main():
+    print(f"{'steps':>6} {'bisect':>10} {'linear':>10} {'linear+tolist':>14}")
+    for steps in STEP_COUNTS:
+        lookup_us, linear_us, tensor_us = bench(steps)
+        print(f"{steps:>6} {lookup_us:>8.2f}us {linear_us:>8.2f}us {tensor_us:>12.2f}us")
+
+
+if __name__ == "__main__":
+    main()
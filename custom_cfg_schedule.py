@@ -1,41 +1,42 @@
-import threading
+import ast
 import math
 import traceback
+import collections
+import csv
+import io
+import json
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+import numpy as np
+import torch
 import comfy.samplers
+import comfy.patcher_extension
 
-_original_sampling_function = comfy.samplers.sampling_function
-_sampling_function_patched = False
+CFG_SCHEDULE_OPTIONS_KEY = "custom_cfg_schedule"
+SCHEDULE_EXPANSION_CACHE_SIZE = 128
+PROFILE_BUFFER_SIZE = 1000
 
-thread_local_data = threading.local()
+_schedule_expansion_cache = collections.OrderedDict()
 
-def set_active_cfg_info(info_dict):
-    thread_local_data.active_cfg_info = info_dict
+def get_active_cfg_info(model_options):
+    return model_options.get("transformer_options", {}).get(CFG_SCHEDULE_OPTIONS_KEY)
 
-def get_active_cfg_info():
-    return getattr(thread_local_data, 'active_cfg_info', None)
+def cfg_schedule_predict_noise_wrapper(executor, x, timestep, model_options={}, seed=None):
+    guider = executor.class_obj
+    if get_active_cfg_info(model_options) is None or type(guider).predict_noise is not comfy.samplers.CFGGuider.predict_noise:
+        return executor(x, timestep, model_options, seed)
+    return patched_sampling_function(guider.inner_model, x, timestep, guider.conds.get("negative", None),
+                                     guider.conds.get("positive", None), guider.cfg, model_options=model_options, seed=seed)
 
-def clear_active_cfg_info():
-    if hasattr(thread_local_data, 'active_cfg_info'):
-        del thread_local_data.active_cfg_info
-
-def apply_sampling_patch():
-    global _sampling_function_patched, _original_sampling_function
-    if not _sampling_function_patched:
-        _original_sampling_function = comfy.samplers.sampling_function
-        comfy.samplers.sampling_function = patched_sampling_function
-        _sampling_function_patched = True
-        print("[CustomCFG Patcher] comfy.samplers.sampling_function patched successfully.")
-        return True
-    return False
-
-def remove_sampling_patch():
-    global _sampling_function_patched, _original_sampling_function
-    if _sampling_function_patched:
-        comfy.samplers.sampling_function = _original_sampling_function
-        _sampling_function_patched = False
-        print("[CustomCFG Patcher] Original comfy.samplers.sampling_function restored.")
-        return True
-    return False
+def attach_cfg_schedule(model, info_dict):
+    scheduled_model = model.clone()
+    transformer_options = scheduled_model.model_options.get("transformer_options", {}).copy()
+    transformer_options[CFG_SCHEDULE_OPTIONS_KEY] = info_dict
+    scheduled_model.model_options["transformer_options"] = transformer_options
+    scheduled_model.add_wrapper_with_key(comfy.patcher_extension.WrappersMP.PREDICT_NOISE,
+                                         CFG_SCHEDULE_OPTIONS_KEY, cfg_schedule_predict_noise_wrapper)
+    return scheduled_model
 
 def find_sigma_index(sigma_value, sigmas_tensor_or_list):
     if sigmas_tensor_or_list is None or len(sigmas_tensor_or_list) == 0:
@@ -81,12 +82,295 @@ def find_sigma_index(sigma_value, sigmas_tensor_or_list):
     print(f"[CustomCFG Helper] Defaulting to closest sigma index: {closest_index} for sigma {sigma_value:.4f}.")
     return closest_index
 
+class SigmaStepLookup:
+    __slots__ = ("values", "descending", "num_sigmas")
+
+    def __init__(self, sigmas_tensor_or_list):
+        sigmas_list = sigmas_tensor_or_list.tolist() if hasattr(sigmas_tensor_or_list, 'tolist') else list(sigmas_tensor_or_list)
+        self.num_sigmas = len(sigmas_list)
+        self.descending = self.num_sigmas > 1 and sigmas_list[0] > sigmas_list[-1]
+        self.values = array('d', reversed(sigmas_list) if self.descending else sigmas_list)
+
+    def __len__(self):
+        return self.num_sigmas
+
+    def step_values(self):
+        return list(reversed(self.values)) if self.descending else list(self.values)
+
+    def _to_step(self, pos):
+        return self.num_sigmas - 1 - pos if self.descending else pos
+
+    def index(self, sigma_value):
+        values = self.values
+        n = self.num_sigmas
+        if n <= 1:
+            return 0
+
+        pos = bisect_left(values, sigma_value)
+        if pos < n and math.isclose(values[pos], sigma_value):
+            return self._to_step(pos)
+        if pos > 0 and math.isclose(values[pos - 1], sigma_value):
+            return self._to_step(pos - 1)
+
+        if pos == 0:
+            return self._to_step(0)
+        if pos == n:
+            return self._to_step(n - 1)
+        if self.descending:
+            return self._to_step(pos)
+        return bisect_right(values, sigma_value) - 1
+
+def expand_effective_schedule(effective_schedule, num_values_needed, interpolate, loop_length_count):
+    point_steps = np.array([p[0] for p in effective_schedule], dtype=np.int64)
+    point_cfgs = np.array([p[1] for p in effective_schedule], dtype=np.float64)
+    point_skips = np.array([bool(p[2]) for p in effective_schedule], dtype=bool)
+    num_points = len(effective_schedule)
+
+    reference_steps = np.arange(num_values_needed, dtype=np.int64)
+    if loop_length_count > 0:
+        reference_steps %= loop_length_count
+
+    start_idx = np.searchsorted(point_steps, reference_steps, side="right") - 1
+    before_first = start_idx < 0
+    start_idx = np.maximum(start_idx, 0)
+
+    step_skip_unconds = point_skips[start_idx]
+    if not interpolate:
+        step_cfgs = point_cfgs[start_idx]
+    else:
+        end_idx = np.where(before_first, 0, np.minimum(start_idx + 1, num_points - 1))
+        seg_start_steps = point_steps[start_idx]
+        seg_start_cfgs = point_cfgs[start_idx]
+        denominators = (point_steps[end_idx] - seg_start_steps).astype(np.float64)
+        valid_segments = denominators > 1e-6
+        interp_t = np.zeros(num_values_needed, dtype=np.float64)
+        np.divide(reference_steps - seg_start_steps, denominators, out=interp_t, where=valid_segments)
+        np.clip(interp_t, 0.0, 1.0, out=interp_t)
+        step_cfgs = seg_start_cfgs + (point_cfgs[end_idx] - seg_start_cfgs) * interp_t
+
+    return step_cfgs.tolist(), step_skip_unconds.tolist()
+
+class CompiledCFGCurve:
+    ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Constant,
+                     ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.USub, ast.UAdd)
+    VARIABLES = ("step", "steps", "t", "cfg", "sigma", "sigma_max", "sigma_min", "pi", "e")
+    SIGMA_VARIABLES = ("sigma", "sigma_max", "sigma_min", "sigma_prop")
+    FUNCTIONS = ("sin", "cos", "tan", "exp", "log", "sqrt", "abs", "min", "max", "pow", "clamp", "lerp",
+                 "cosine", "exponential", "sigma_prop")
+    MAX_EXPRESSION_LENGTH = 1000
+
+    def __init__(self, expression):
+        self.expression = expression.strip()
+        if len(self.expression) > self.MAX_EXPRESSION_LENGTH:
+            raise ValueError(f"Curve expression is too long ({len(self.expression)} characters, limit {self.MAX_EXPRESSION_LENGTH}).")
+        try:
+            self._compile()
+        except (RecursionError, MemoryError):
+            raise ValueError("Curve expression is too deeply nested.")
+
+    def _compile(self):
+        try:
+            tree = ast.parse(self.expression, mode="eval")
+        except SyntaxError as e:
+            raise ValueError(f"Invalid curve expression '{self.expression}': {e.msg}")
+
+        used_names = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, self.ALLOWED_NODES):
+                raise ValueError(f"Unsupported syntax '{type(node).__name__}' in curve expression.")
+            if isinstance(node, ast.Constant) and (isinstance(node.value, bool) or not isinstance(node.value, (int, float))):
+                raise ValueError(f"Unsupported constant {node.value!r} in curve expression.")
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in self.FUNCTIONS or node.keywords:
+                    raise ValueError(f"Unsupported function call in curve expression: '{ast.unparse(node)}'.")
+            elif isinstance(node, ast.Name):
+                if node.id not in self.VARIABLES and node.id not in self.FUNCTIONS:
+                    raise ValueError(f"Unknown name '{node.id}' in curve expression.")
+                used_names.add(node.id)
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Constant):
+                try:
+                    node.value = float(node.value)
+                except OverflowError:
+                    raise ValueError(f"Unsupported constant in curve expression: '{ast.unparse(node)[:32]}...' is out of range.")
+        self.uses_sigma = any(name in used_names for name in self.SIGMA_VARIABLES)
+        self._code = compile(tree, "<cfg_curve>", "eval")
+
+    def evaluate(self, point_cfgs, step_sigmas=None):
+        num_steps = len(point_cfgs)
+        if self.uses_sigma and step_sigmas is None:
+            raise ValueError("Curve expression uses sigma, but no SIGMAS input is connected.")
+
+        steps = np.arange(num_steps, dtype=np.float64)
+        t = steps / max(num_steps - 1, 1)
+        sigma = np.asarray(step_sigmas, dtype=np.float64) if step_sigmas is not None else np.zeros(num_steps)
+        sigma_max = float(sigma.max()) if num_steps else 0.0
+        sigma_min = float(sigma.min()) if num_steps else 0.0
+        sigma_range = sigma_max - sigma_min
+        sigma_frac = (sigma - sigma_min) / sigma_range if sigma_range > 0 else np.ones(num_steps)
+
+        def lerp(a, b, w):
+            return a + (b - a) * w
+
+        def exponential(a, b):
+            a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+            same_sign = a * b > 0
+            ratio = np.where(same_sign, b, 1.0) / np.where(same_sign, a, 1.0)
+            return np.where(same_sign, a * np.power(ratio, t), lerp(a, b, t))
+
+        env = {
+            "step": steps, "steps": float(num_steps), "t": t, "cfg": np.asarray(point_cfgs, dtype=np.float64),
+            "sigma": sigma, "sigma_max": sigma_max, "sigma_min": sigma_min, "pi": math.pi, "e": math.e,
+            "sin": np.sin, "cos": np.cos, "tan": np.tan, "exp": np.exp, "log": np.log, "sqrt": np.sqrt,
+            "abs": np.abs, "min": np.minimum, "max": np.maximum, "pow": np.power,
+            "clamp": lambda x, lo, hi: np.clip(x, lo, hi),
+            "lerp": lerp,
+            "cosine": lambda a, b: b + (a - b) * 0.5 * (1.0 + np.cos(np.pi * t)),
+            "exponential": exponential,
+            "sigma_prop": lambda a, b: b + (a - b) * sigma_frac,
+        }
+        try:
+            with np.errstate(all="ignore"):
+                result = eval(self._code, {"__builtins__": {}}, env)
+                step_cfgs = np.broadcast_to(np.asarray(result, dtype=np.float64), (num_steps,))
+        except (ArithmeticError, TypeError, ValueError) as e:
+            raise ValueError(f"Could not evaluate curve expression '{self.expression}': {e}")
+        if not np.all(np.isfinite(step_cfgs)):
+            bad_step = int(np.argmin(np.isfinite(step_cfgs)))
+            raise ValueError(f"Curve expression produced a non-finite CFG at step {bad_step}.")
+        return step_cfgs.tolist()
+
+def resolve_batch_cfgs(batch_step_cfgs, batch_step_skip_unconds, step_index, batch_size):
+    cfgs = []
+    skips = []
+    num_schedules = len(batch_step_cfgs)
+    for item_idx in range(batch_size):
+        sched_cfgs = batch_step_cfgs[item_idx % num_schedules]
+        sched_skips = batch_step_skip_unconds[item_idx % num_schedules]
+        sched_step = min(step_index, len(sched_cfgs) - 1)
+        cfgs.append(sched_cfgs[sched_step])
+        skips.append(sched_skips[sched_step])
+    return cfgs, skips
+
+def calc_cond_batch_per_sample(model, cond, uncond, needs_uncond, x, timestep, model_options):
+    if uncond is None or not any(needs_uncond):
+        return comfy.samplers.calc_cond_batch(model, [cond, None], x, timestep, model_options), None
+    if all(needs_uncond):
+        return comfy.samplers.calc_cond_batch(model, [cond, uncond], x, timestep, model_options), uncond
+
+    uncond_indices = torch.tensor([i for i, needed in enumerate(needs_uncond) if needed], device=x.device)
+    sub_timestep = timestep
+    if hasattr(timestep, 'shape') and timestep.ndim > 0 and timestep.shape[0] == x.shape[0]:
+        sub_timestep = timestep.index_select(0, uncond_indices.to(timestep.device))
+
+    cond_pred = comfy.samplers.calc_cond_batch(model, [cond], x, timestep, model_options)[0]
+    uncond_sub_pred = comfy.samplers.calc_cond_batch(model, [uncond], x.index_select(0, uncond_indices), sub_timestep, model_options)[0]
+    uncond_pred = torch.zeros_like(cond_pred)
+    uncond_pred.index_copy_(0, uncond_indices, uncond_sub_pred)
+    return [cond_pred, uncond_pred], uncond
+
+class CFGStepProfiler:
+    FIELDS = ("step", "sigma", "lookup", "uncond", "batch_size", "calc_cond_batch_ms", "cfg_function_ms")
+
+    def __init__(self, max_records=PROFILE_BUFFER_SIZE):
+        self.records = collections.deque(maxlen=max_records)
+
+    def timestamp(self, x):
+        if x.device.type == "cuda":
+            torch.cuda.synchronize(x.device)
+        return time.perf_counter()
+
+    def record(self, **fields):
+        self.records.append(fields)
+
+    def drain(self):
+        records = list(self.records)
+        self.records.clear()
+        return records
+
+    @staticmethod
+    def summarize(records):
+        if not records:
+            return "No sampler calls recorded yet"
+        calc_total = sum(r["calc_cond_batch_ms"] for r in records)
+        cfg_total = sum(r["cfg_function_ms"] for r in records)
+        by_mode = collections.defaultdict(list)
+        for r in records:
+            by_mode[r["uncond"].split(" ")[0]].append(r["calc_cond_batch_ms"])
+        mode_parts = [f"{mode}: {len(times)} calls, avg {sum(times) / len(times):.2f} ms" for mode, times in sorted(by_mode.items())]
+        return (f"{len(records)} calls, calc_cond_batch total {calc_total:.1f} ms, cfg_function total {cfg_total:.1f} ms "
+                f"({'; '.join(mode_parts)})")
+
+    @classmethod
+    def format_records(cls, records, output_format):
+        rounded = [{k: round(v, 4) if isinstance(v, float) else v for k, v in r.items()} for r in records]
+        if output_format == "CSV":
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=cls.FIELDS, extrasaction="ignore", lineterminator="\n")
+            writer.writeheader()
+            writer.writerows(rounded)
+            return buffer.getvalue().rstrip("\n")
+        return json.dumps(rounded, indent=1)
+
+class AdaptiveSkipReport:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.full_passes = 0
+        self.skipped_passes = 0
+        self.max_skip_ratio = 0.0
+        self.max_drift = 0.0
+
+    def summary(self):
+        total_passes = self.full_passes + self.skipped_passes
+        if total_passes == 0:
+            return "No sampler run recorded yet"
+        return (f"{self.skipped_passes}/{total_passes} uncond passes skipped, "
+                f"max guidance ratio when skipping: {self.max_skip_ratio:.4f}, "
+                f"max measured drift at re-probe: {self.max_drift:.4f}")
+
+def calc_cond_batch_adaptive(model, cond, uncond, x, timestep, model_options, step_index, cfg_scale, active_cfg_info):
+    state = active_cfg_info["adaptive_state"]
+    report = active_cfg_info["adaptive_report"]
+    if not state or step_index < state["last_step"]:
+        state.clear()
+        state.update(last_step=step_index, last_probe_step=step_index, last_delta=None,
+                     last_ratio=float("inf"), skipped_since_probe=False)
+        report.reset()
+    state["last_step"] = step_index
+
+    last_delta = state["last_delta"]
+    if last_delta is not None and last_delta.shape == x.shape and \
+       state["last_ratio"] < active_cfg_info["adaptive_skip_threshold"] and \
+       step_index - state["last_probe_step"] < active_cfg_info["adaptive_probe_interval"]:
+        cond_pred = comfy.samplers.calc_cond_batch(model, [cond, None], x, timestep, model_options)[0]
+        state["skipped_since_probe"] = True
+        report.skipped_passes += 1
+        report.max_skip_ratio = max(report.max_skip_ratio, state["last_ratio"])
+        return [cond_pred, cond_pred - last_delta], True
+
+    out_cond_batch = comfy.samplers.calc_cond_batch(model, [cond, uncond], x, timestep, model_options)
+    delta = out_cond_batch[0] - out_cond_batch[1]
+    guidance_weight = abs(cfg_scale - 1.0)
+    cond_norm = torch.linalg.vector_norm(out_cond_batch[0], dtype=torch.float32).clamp_min(1e-8)
+    ratio = (guidance_weight * torch.linalg.vector_norm(delta, dtype=torch.float32) / cond_norm).item()
+    if state["skipped_since_probe"] and last_delta is not None and last_delta.shape == delta.shape:
+        drift = (guidance_weight * torch.linalg.vector_norm(delta - last_delta, dtype=torch.float32) / cond_norm).item()
+        report.max_drift = max(report.max_drift, drift)
+    state.update(last_delta=delta, last_ratio=ratio, last_probe_step=step_index, skipped_since_probe=False)
+    report.full_passes += 1
+    return out_cond_batch, False
+
 def patched_sampling_function(model, x, timestep, uncond, cond, cond_scale, model_options={}, seed=None):
-    active_cfg_info = get_active_cfg_info()
+    active_cfg_info = get_active_cfg_info(model_options)
     cfg_to_use = cond_scale
     force_skip_uncond_this_step = False
     step_index = -1
     sigmas_for_search_in_patch = None
+    lookup_method = "none"
+    current_sigma_value_for_log = None
     if active_cfg_info:
         uses_call_counter = active_cfg_info.get("uses_call_counter_for_step", False)
         current_sigma_value_for_log = timestep[0].item() if hasattr(timestep, 'item') and not isinstance(timestep, (float, int)) else timestep
@@ -96,25 +380,30 @@ def patched_sampling_function(model, x, timestep, uncond, cond, cond_scale, mode
         if uses_call_counter:
             active_cfg_info["call_counter"] = active_cfg_info.get("call_counter", -1) + 1
             step_index = active_cfg_info["call_counter"]
+            lookup_method = "call_counter"
         else:
             current_sigma_value = current_sigma_value_for_log 
 
-            sigmas_from_node_input = active_cfg_info.get("sigmas_for_step_lookup")
-            sigmas_from_options_transformer = model_options.get("transformer_options", {}).get("sample_sigmas")
-            sigmas_from_options_direct = model_options.get("sigmas")
-
-            if sigmas_from_node_input is not None and \
-               (not hasattr(sigmas_from_node_input, 'numel') or sigmas_from_node_input.numel() > 0):
-                sigmas_for_search_in_patch = sigmas_from_node_input
-            elif sigmas_from_options_transformer is not None and \
-                 (not hasattr(sigmas_from_options_transformer, 'numel') or sigmas_from_options_transformer.numel() > 0):
-                sigmas_for_search_in_patch = sigmas_from_options_transformer
-            elif sigmas_from_options_direct is not None and \
-                 (not hasattr(sigmas_from_options_direct, 'numel') or sigmas_from_options_direct.numel() > 0):
-                sigmas_for_search_in_patch = sigmas_from_options_direct
-            
-            if sigmas_for_search_in_patch is not None and len(sigmas_for_search_in_patch) > 0:
+            sigma_lookup = active_cfg_info.get("sigma_lookup")
+            if sigma_lookup is not None and len(sigma_lookup) > 0:
+                sigmas_for_search_in_patch = sigma_lookup
+            else:
+                sigmas_from_options_transformer = model_options.get("transformer_options", {}).get("sample_sigmas")
+                sigmas_from_options_direct = model_options.get("sigmas")
+
+                if sigmas_from_options_transformer is not None and \
+                   (not hasattr(sigmas_from_options_transformer, 'numel') or sigmas_from_options_transformer.numel() > 0):
+                    sigmas_for_search_in_patch = sigmas_from_options_transformer
+                elif sigmas_from_options_direct is not None and \
+                     (not hasattr(sigmas_from_options_direct, 'numel') or sigmas_from_options_direct.numel() > 0):
+                    sigmas_for_search_in_patch = sigmas_from_options_direct
+
+            if sigma_lookup is not None and sigmas_for_search_in_patch is sigma_lookup:
+                step_index = sigma_lookup.index(current_sigma_value)
+                lookup_method = "bisect"
+            elif sigmas_for_search_in_patch is not None and len(sigmas_for_search_in_patch) > 0:
                 step_index = find_sigma_index(current_sigma_value, sigmas_for_search_in_patch)
+                lookup_method = "linear"
             else:
                 print(f"[CustomCFG Patched] Warning: No valid sigmas found for step lookup (sigma: {current_sigma_value:.4f}). Default CFG will be used.")
 
@@ -135,28 +424,42 @@ def patched_sampling_function(model, x, timestep, uncond, cond, cond_scale, mode
                     print(f"[CustomCFG Patched] Warning: step_index {step_index} (sigma {current_sigma_value_for_log:.4f}) "
                           f"but no CFGs scheduled. Using default cond_scale {cond_scale:.2f}.")
 
-                total_steps_in_schedule = 0
-                if uses_call_counter:
-                    total_steps_in_schedule = active_cfg_info.get("total_steps_scheduled_by_override", 0)
-                elif sigmas_for_search_in_patch is not None:
-                    total_steps_in_schedule = len(sigmas_for_search_in_patch)
-
-                if total_steps_in_schedule > 0 and step_index >= (total_steps_in_schedule - 1):
-                    if not active_cfg_info.get("schedule_completed", False):
-                        active_cfg_info["schedule_completed"] = True
-
             except Exception as e:
                 print(f"[CustomCFG Patched] Error applying CFG schedule for sigma {current_sigma_value_for_log:.4f} (step_index {step_index}): {e}")
                 traceback.print_exc()
     
+    per_sample_cfgs = None
+    if active_cfg_info and step_index != -1 and active_cfg_info.get("batch_step_cfgs"):
+        per_sample_cfgs, per_sample_skips = resolve_batch_cfgs(active_cfg_info["batch_step_cfgs"], active_cfg_info["batch_step_skip_unconds"],
+                                                               step_index, x.shape[0])
+        if len(set(per_sample_cfgs)) == 1 and len(set(per_sample_skips)) == 1:
+            cfg_to_use, force_skip_uncond_this_step = per_sample_cfgs[0], per_sample_skips[0]
+            per_sample_cfgs = None
+
     uncond_to_process = uncond
     disable_cfg1_optimization = model_options.get("disable_cfg1_optimization", False)
+    profiler = active_cfg_info.get("profiler") if active_cfg_info else None
 
-    if force_skip_uncond_this_step or (math.isclose(cfg_to_use, 1.0) and not disable_cfg1_optimization):
-        uncond_to_process = None
-    
     try:
-        out_cond_batch = comfy.samplers.calc_cond_batch(model, [cond, uncond_to_process], x, timestep, model_options)
+        if profiler is not None:
+            calc_start = profiler.timestamp(x)
+        if per_sample_cfgs is not None:
+            needs_uncond = [not skip and (disable_cfg1_optimization or not math.isclose(cfg, 1.0))
+                            for cfg, skip in zip(per_sample_cfgs, per_sample_skips)]
+            out_cond_batch, uncond_to_process = calc_cond_batch_per_sample(model, cond, uncond, needs_uncond, x, timestep, model_options)
+            cfg_to_use = torch.tensor(per_sample_cfgs, device=x.device, dtype=x.dtype).view((-1,) + (1,) * (x.ndim - 1))
+            uncond_mode = "full" if uncond_to_process is not None and all(needs_uncond) else \
+                          f"sub-batch {sum(needs_uncond)}/{len(needs_uncond)}" if uncond_to_process is not None else "skipped"
+        else:
+            if force_skip_uncond_this_step or (math.isclose(cfg_to_use, 1.0) and not disable_cfg1_optimization):
+                uncond_to_process = None
+            uncond_mode = "full" if uncond_to_process is not None else "skipped"
+            if uncond_to_process is not None and step_index != -1 and active_cfg_info.get("adaptive_skip_threshold", 0.0) > 0:
+                out_cond_batch, reused_delta = calc_cond_batch_adaptive(model, cond, uncond_to_process, x, timestep, model_options,
+                                                                        step_index, cfg_to_use, active_cfg_info)
+                if reused_delta: uncond_mode = "reused"
+            else:
+                out_cond_batch = comfy.samplers.calc_cond_batch(model, [cond, uncond_to_process], x, timestep, model_options)
         args_pre_cfg = {
             "conds": [cond, uncond_to_process], "conds_out": out_cond_batch, "cond_scale": cfg_to_use,
             "timestep": timestep, "input": x, "sigma": timestep, 
@@ -164,7 +467,15 @@ def patched_sampling_function(model, x, timestep, uncond, cond, cond_scale, mode
         }
         for fn in model_options.get("sampler_pre_cfg_function", []):
             out_cond_batch = fn(args_pre_cfg)
-        return comfy.samplers.cfg_function(model, out_cond_batch[0], out_cond_batch[1], cfg_to_use, x, timestep, model_options, cond, uncond_to_process)
+        if profiler is not None:
+            cfg_start = profiler.timestamp(x)
+        cfg_result = comfy.samplers.cfg_function(model, out_cond_batch[0], out_cond_batch[1], cfg_to_use, x, timestep, model_options, cond, uncond_to_process)
+        if profiler is not None:
+            cfg_end = profiler.timestamp(x)
+            profiler.record(step=step_index, sigma=current_sigma_value_for_log, lookup=lookup_method, uncond=uncond_mode,
+                            batch_size=x.shape[0], calc_cond_batch_ms=(cfg_start - calc_start) * 1000.0,
+                            cfg_function_ms=(cfg_end - cfg_start) * 1000.0)
+        return cfg_result
     except Exception as e:
         print(f"[CustomCFG Patched] Critical error in patched_sampling_function: {e}")
         traceback.print_exc()
@@ -185,7 +496,12 @@ class CustomCFGSchedule:
             "optional": {
                 "sigmas": ("SIGMAS",),
                 "total_steps_override": ("INT", {"default": 0, "min": 0, "max": 1000, "step": 1, "label": "Total Steps (if no SIGMAS input, 0=disabled)"}),
-                "passthrough_model": ("MODEL",)
+                "passthrough_model": ("MODEL",),
+                "cfg_curve": ("STRING", {"multiline": False, "default": ""}),
+                "adaptive_skip_threshold": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 10.0, "step": 0.001, "label": "Adaptive Uncond Skip Threshold (0=disabled)"}),
+                "adaptive_probe_interval": ("INT", {"default": 4, "min": 1, "max": 1000, "step": 1}),
+                "profile_steps": ("BOOLEAN", {"default": False, "label_on": "Profile Steps", "label_off": "No Profiling"}),
+                "profile_format": (["JSON", "CSV"], {"default": "JSON"}),
             }
         }
 
@@ -197,6 +513,8 @@ class CustomCFGSchedule:
 
     def __init__(self):
         self._last_resolved_points_for_display = []
+        self._adaptive_report = AdaptiveSkipReport()
+        self._profiler = CFGStepProfiler()
 
     def _parse_schedule_points(self, schedule_text):
         schedule_list = []
@@ -281,6 +599,25 @@ class CustomCFGSchedule:
 
     def _expand_schedule_to_steps(self, raw_point_schedule, initial_cfg_value, total_steps_max_idx, 
                                   interpolate=False, loop_length_count=0, allow_overshoot=False):
+        cache_key = (tuple(raw_point_schedule or ()), initial_cfg_value, total_steps_max_idx,
+                     bool(interpolate), loop_length_count, bool(allow_overshoot))
+        cached = _schedule_expansion_cache.get(cache_key)
+        if cached is not None:
+            _schedule_expansion_cache.move_to_end(cache_key)
+            step_cfgs, step_skip_unconds, display_points = cached
+            self._last_resolved_points_for_display = list(display_points)
+            return list(step_cfgs), list(step_skip_unconds)
+
+        step_cfgs, step_skip_unconds = self._expand_schedule_uncached(raw_point_schedule, initial_cfg_value, total_steps_max_idx,
+                                                                      interpolate, loop_length_count, allow_overshoot)
+        if step_cfgs:
+            _schedule_expansion_cache[cache_key] = (tuple(step_cfgs), tuple(step_skip_unconds), tuple(self._last_resolved_points_for_display))
+            while len(_schedule_expansion_cache) > SCHEDULE_EXPANSION_CACHE_SIZE:
+                _schedule_expansion_cache.popitem(last=False)
+        return step_cfgs, step_skip_unconds
+
+    def _expand_schedule_uncached(self, raw_point_schedule, initial_cfg_value, total_steps_max_idx, 
+                                  interpolate=False, loop_length_count=0, allow_overshoot=False):
         self._last_resolved_points_for_display = [] 
         num_values_needed = total_steps_max_idx + 1 if total_steps_max_idx >= 0 else 0
 
@@ -323,76 +660,65 @@ class CustomCFGSchedule:
             print(f"[CustomCFG Node] Critical Error: Effective schedule became empty. Using initial_cfg for {num_values_needed} values.")
             return [initial_cfg_value] * num_values_needed, [False] * num_values_needed
 
-        step_cfgs = [0.0] * num_values_needed
-        step_skip_unconds = [False] * num_values_needed
-
-        for i in range(num_values_needed):
-            current_target_step = i
-            reference_step = current_target_step % loop_length_count if loop_length_count > 0 else current_target_step
-
-            cfg_val_for_step = effective_schedule[0][1]
-            skip_val_for_step = effective_schedule[0][2]
-
-            if not interpolate:
-                for p_target_s, p_cfg, p_skip in effective_schedule:
-                    if p_target_s <= reference_step:
-                        cfg_val_for_step = p_cfg
-                        skip_val_for_step = p_skip
-                    else: break 
-            else: 
-                seg_start_step, seg_start_cfg, seg_start_skip = effective_schedule[0]
-                seg_end_step, seg_end_cfg = seg_start_step, seg_start_cfg
-
-                if reference_step >= effective_schedule[0][0]:
-                    for p_idx, (p_t_step, p_t_cfg, p_t_skip) in enumerate(effective_schedule):
-                        if p_t_step <= reference_step:
-                            seg_start_step, seg_start_cfg, seg_start_skip = p_t_step, p_t_cfg, p_t_skip
-                            if p_idx + 1 < len(effective_schedule):
-                                seg_end_step, seg_end_cfg = effective_schedule[p_idx+1][0], effective_schedule[p_idx+1][1]
-                            else: 
-                                seg_end_step, seg_end_cfg = p_t_step, p_t_cfg 
-                        else: 
-                            seg_end_step, seg_end_cfg = p_t_step, p_t_cfg
-                            break 
-                
-                denominator = float(seg_end_step - seg_start_step)
-                if denominator > 1e-6: 
-                    interp_t = (reference_step - seg_start_step) / denominator
-                    interp_t = max(0.0, min(1.0, interp_t)) 
-                    cfg_val_for_step = seg_start_cfg + (seg_end_cfg - seg_start_cfg) * interp_t
-                else: 
-                    cfg_val_for_step = seg_start_cfg
-                skip_val_for_step = seg_start_skip
-            
-            step_cfgs[i] = cfg_val_for_step
-            step_skip_unconds[i] = skip_val_for_step
-            
-        return step_cfgs, step_skip_unconds
+        return expand_effective_schedule(effective_schedule, num_values_needed, interpolate, loop_length_count)
+
+    def _split_schedule_blocks(self, schedule_text):
+        if not schedule_text:
+            return [""]
+        normalized_text = schedule_text.replace('\r\n', '\n').replace('\r', '\n')
+        blocks = [[]]
+        for line in normalized_text.split('\n'):
+            if line.strip() == "---":
+                blocks.append([])
+            else:
+                blocks[-1].append(line)
+        block_texts = ["\n".join(lines) for lines in blocks]
+        non_empty_blocks = [text for text in block_texts if text.strip()]
+        return non_empty_blocks if non_empty_blocks else [block_texts[0]]
+
+    def _format_schedule_lines(self, display_basis, expanded_step_cfgs, expanded_step_skip_unconds, initial_cfg,
+                               effective_loop_length, allow_overshoot_and_trim, num_schedule_values):
+        lines = []
+        resolved_pts_display = []
+        if effective_loop_length > 0 and not allow_overshoot_and_trim:
+            filtered_basis = [pt for pt in display_basis if pt[0] < effective_loop_length]
+            if not filtered_basis and display_basis: 
+                 initial_pt_display = next((p for p in display_basis if p[0]==0), None)
+                 if initial_pt_display: filtered_basis = [initial_pt_display]
+            display_basis = filtered_basis if filtered_basis else display_basis
+
+        for res_step, p_cfg, p_skip, orig_str in display_basis:
+            orig_cleaned = orig_str.replace("(initial_cfg)",f"(initial:{initial_cfg:.1f})")
+            resolved_pts_display.append(f"{orig_cleaned} -> {res_step}:{p_cfg:.1f}{':s' if p_skip else ''}")
+        if not resolved_pts_display and initial_cfg is not None: 
+            resolved_pts_display.append(f"0 (initial):{initial_cfg:.1f} (Default)")
+        lines.append(f"Resolved Basis Points: [{', '.join(resolved_pts_display)}]")
+
+        display_limit = min(20, num_schedule_values)
+        cfgs_formatted = [f"{cfgs:.2f}{':s' if skips else ''}" 
+                          for cfgs, skips in zip(expanded_step_cfgs[:display_limit], expanded_step_skip_unconds[:display_limit])]
+        cfgs_str = ", ".join(cfgs_formatted)
+        if display_limit < num_schedule_values: cfgs_str += f", ... ({num_schedule_values - display_limit} more)"
+        lines.append(f"Expanded CFGs (first {display_limit}): [{cfgs_str}]")
+        return lines
 
     def apply_schedule(self, enabled, initial_cfg, cfg_schedule_points, schedule_loop_length, 
                        interpolate, allow_overshoot_and_trim, 
-                       sigmas=None, total_steps_override=0, passthrough_model=None):
+                       sigmas=None, total_steps_override=0, passthrough_model=None, cfg_curve="",
+                       adaptive_skip_threshold=0.0, adaptive_probe_interval=4, profile_steps=False, profile_format="JSON"):
         info_lines = []
         node_class_name = self.__class__.__name__
         
-        previous_active_info = get_active_cfg_info() 
-        clear_active_cfg_info() 
-
-        if previous_active_info:
-            was_interrupted = not previous_active_info.get("schedule_completed", True)
-            patched_by_this_type = previous_active_info.get("patch_applied_by_this_node_type") == node_class_name
-            if was_interrupted and patched_by_this_type and not enabled:
-                print(f"[{node_class_name}] Disabled after interruption. Cleaning up patch.")
-                if remove_sampling_patch(): info_lines.append(f"CustomCFG ({node_class_name}): Disabled (cleaned up patch)")
-
         if not enabled:
-            info_lines.insert(0, f"CustomCFG ({node_class_name}): Disabled")
+            info_lines.append(f"CustomCFG ({node_class_name}): Disabled")
             print(f"[{node_class_name}] CustomCFG is disabled.")
-            if previous_active_info and previous_active_info.get("patch_applied_by_this_node_type") == node_class_name:
-                if _sampling_function_patched and remove_sampling_patch():
-                     info_lines[0] += " (Removed own patch)"
             return ("\n".join(info_lines), passthrough_model, sigmas)
 
+        if passthrough_model is None:
+            msg = f"CustomCFG ({node_class_name}): Enabled (Error: passthrough_model is not connected. The schedule is carried on passthrough_model_out.)"
+            print(f"[{node_class_name}] Error: passthrough_model input missing. Nothing to attach the schedule to.")
+            return (msg, passthrough_model, sigmas)
+
         num_schedule_values = 0
         total_steps_max_idx = -1
         uses_call_counter_for_step = False
@@ -410,10 +736,6 @@ class CustomCFGSchedule:
         else:
             msg = f"CustomCFG ({node_class_name}): Enabled (Error: Neither SIGMAS input nor valid Total Steps Override provided)"
             print(f"[{node_class_name}] Error: SIGMAS input missing/invalid and Total Steps Override is not positive.")
-            if _sampling_function_patched and previous_active_info and \
-               previous_active_info.get("patch_applied_by_this_node_type") == node_class_name and \
-               remove_sampling_patch():
-                msg += "\n(Removed own patch)"
             return (msg, passthrough_model, sigmas)
 
         total_steps_max_idx = num_schedule_values - 1
@@ -421,13 +743,9 @@ class CustomCFGSchedule:
         if num_schedule_values == 0 :
             msg = f"CustomCFG ({node_class_name}): Enabled (No sampling steps defined)"
             print(f"[{node_class_name}] No sampling steps determined from inputs.")
-            if _sampling_function_patched and previous_active_info and \
-               previous_active_info.get("patch_applied_by_this_node_type") == node_class_name and \
-               remove_sampling_patch():
-                msg += "\n(Removed own patch)"
             return (msg, passthrough_model, sigmas)
 
-        parsed_point_schedule = self._parse_schedule_points(cfg_schedule_points)
+        schedule_blocks = self._split_schedule_blocks(cfg_schedule_points)
         
         effective_loop_length = schedule_loop_length
         loop_info_str = f"Looping: Disabled (Len {schedule_loop_length})"
@@ -442,32 +760,67 @@ class CustomCFGSchedule:
             else:
                 loop_info_str = f"Looping: Enabled (Length: {schedule_loop_length} steps)"
         
-        expanded_step_cfgs, expanded_step_skip_unconds = self._expand_schedule_to_steps(
-            parsed_point_schedule, initial_cfg, total_steps_max_idx, 
-            interpolate, effective_loop_length, allow_overshoot_and_trim
-        )
-        
-        if not expanded_step_cfgs or len(expanded_step_cfgs) != num_schedule_values:
-            msg = f"CustomCFG ({node_class_name}): Enabled (Error: Failed to expand schedule to {num_schedule_values} values. Check console.)"
-            print(f"[{node_class_name}] Error: Schedule expansion failed. Expected {num_schedule_values} CFG values, got {len(expanded_step_cfgs)}.")
-            return (msg, passthrough_model, sigmas)
+        sigma_lookup = SigmaStepLookup(sigmas_for_step_lookup_in_patch) if sigmas_for_step_lookup_in_patch is not None else None
+        compiled_curve = None
+        if cfg_curve and cfg_curve.strip():
+            try:
+                compiled_curve = CompiledCFGCurve(cfg_curve)
+            except ValueError as e:
+                msg = f"CustomCFG ({node_class_name}): Enabled (Error: {e})"
+                print(f"[{node_class_name}] Error compiling cfg_curve: {e}")
+                return (msg, passthrough_model, sigmas)
+
+        expanded_schedules = []
+        for block_text in schedule_blocks:
+            parsed_point_schedule = self._parse_schedule_points(block_text)
+            expanded_step_cfgs, expanded_step_skip_unconds = self._expand_schedule_to_steps(
+                parsed_point_schedule, initial_cfg, total_steps_max_idx, 
+                interpolate, effective_loop_length, allow_overshoot_and_trim
+            )
+            
+            if not expanded_step_cfgs or len(expanded_step_cfgs) != num_schedule_values:
+                msg = f"CustomCFG ({node_class_name}): Enabled (Error: Failed to expand schedule to {num_schedule_values} values. Check console.)"
+                print(f"[{node_class_name}] Error: Schedule expansion failed. Expected {num_schedule_values} CFG values, got {len(expanded_step_cfgs)}.")
+                return (msg, passthrough_model, sigmas)
+            if compiled_curve is not None:
+                try:
+                    expanded_step_cfgs = compiled_curve.evaluate(expanded_step_cfgs, sigma_lookup.step_values() if sigma_lookup is not None else None)
+                except ValueError as e:
+                    msg = f"CustomCFG ({node_class_name}): Enabled (Error: {e})"
+                    print(f"[{node_class_name}] Error evaluating cfg_curve: {e}")
+                    return (msg, passthrough_model, sigmas)
+            expanded_schedules.append((expanded_step_cfgs, expanded_step_skip_unconds, list(self._last_resolved_points_for_display)))
+
+        expanded_step_cfgs, expanded_step_skip_unconds, _ = expanded_schedules[0]
 
         new_active_info = {
             "step_cfgs": expanded_step_cfgs,
             "step_skip_unconds": expanded_step_skip_unconds,
             "total_steps_max_idx_for_schedule_logic": total_steps_max_idx,
-            "schedule_completed": False,
-            "patch_applied_by_this_node_type": node_class_name,
             "uses_call_counter_for_step": uses_call_counter_for_step,
-            "sigmas_for_step_lookup": sigmas_for_step_lookup_in_patch
+            "sigma_lookup": sigma_lookup
         }
+        if adaptive_skip_threshold > 0:
+            new_active_info["adaptive_skip_threshold"] = adaptive_skip_threshold
+            new_active_info["adaptive_probe_interval"] = max(1, adaptive_probe_interval)
+            new_active_info["adaptive_state"] = {}
+            new_active_info["adaptive_report"] = self._adaptive_report
+        if profile_steps:
+            new_active_info["profiler"] = self._profiler
+        if len(expanded_schedules) > 1:
+            new_active_info["batch_step_cfgs"] = [sched[0] for sched in expanded_schedules]
+            new_active_info["batch_step_skip_unconds"] = [sched[1] for sched in expanded_schedules]
         if uses_call_counter_for_step:
             new_active_info["call_counter"] = -1
             new_active_info["total_steps_scheduled_by_override"] = num_schedule_values
 
-
-        patch_newly_applied = apply_sampling_patch()
-        set_active_cfg_info(new_active_info)
+        try:
+            scheduled_model = attach_cfg_schedule(passthrough_model, new_active_info)
+        except Exception as e:
+            msg = f"CustomCFG ({node_class_name}): Enabled (Error: Could not attach schedule to model: {e})"
+            print(f"[{node_class_name}] Error attaching schedule to passthrough_model: {e}")
+            traceback.print_exc()
+            return (msg, passthrough_model, sigmas)
 
         info_lines.append(f"CustomCFG ({node_class_name}): Enabled")
         info_lines.append(f"Step Source: {step_source_info}")
@@ -480,39 +833,31 @@ class CustomCFGSchedule:
         first_sched_line = cfg_schedule_points.splitlines()[0] if cfg_schedule_points else "N/A"
         info_lines.append(f"Input Str: '{first_sched_line}{'...' if len(cfg_schedule_points.splitlines()) > 1 else ''}'")
 
-        resolved_pts_display = []
-        display_basis = self._last_resolved_points_for_display
-        if effective_loop_length > 0 and not allow_overshoot_and_trim:
-            filtered_basis = [pt for pt in display_basis if pt[0] < effective_loop_length]
-            if not filtered_basis and display_basis: 
-                 initial_pt_display = next((p for p in display_basis if p[0]==0), None)
-                 if initial_pt_display: filtered_basis = [initial_pt_display]
-            display_basis = filtered_basis if filtered_basis else display_basis
-
-        for res_step, p_cfg, p_skip, orig_str in display_basis:
-            orig_cleaned = orig_str.replace("(initial_cfg)",f"(initial:{initial_cfg:.1f})")
-            resolved_pts_display.append(f"{orig_cleaned} -> {res_step}:{p_cfg:.1f}{':s' if p_skip else ''}")
-        if not resolved_pts_display and initial_cfg is not None: 
-            resolved_pts_display.append(f"0 (initial):{initial_cfg:.1f} (Default)")
-        info_lines.append(f"Resolved Basis Points: [{', '.join(resolved_pts_display)}]")
-
-        display_limit = min(20, num_schedule_values)
-        cfgs_formatted = [f"{cfgs:.2f}{':s' if skips else ''}" 
-                          for cfgs, skips in zip(expanded_step_cfgs[:display_limit], expanded_step_skip_unconds[:display_limit])]
-        cfgs_str = ", ".join(cfgs_formatted)
-        if display_limit < num_schedule_values: cfgs_str += f", ... ({num_schedule_values - display_limit} more)"
-        info_lines.append(f"Expanded CFGs (first {display_limit}): [{cfgs_str}]")
-
-        patch_status_msg = "Patch Status: "
-        if patch_newly_applied: patch_status_msg += "Newly applied."
-        elif _sampling_function_patched: patch_status_msg += "Already active. Schedule (re)set."
-        else: patch_status_msg += "Error - Inactive after attempt."
-        info_lines.append(patch_status_msg)
+        if adaptive_skip_threshold > 0:
+            info_lines.append(f"Adaptive Uncond Skip: Enabled (Threshold: {adaptive_skip_threshold:.4f}, Probe Interval: {max(1, adaptive_probe_interval)} steps)")
+            info_lines.append(f"Adaptive Skip (previous run): {self._adaptive_report.summary()}")
+        if compiled_curve is not None:
+            info_lines.append(f"CFG Curve: {compiled_curve.expression}")
+        if len(expanded_schedules) > 1:
+            info_lines.append(f"Batch Schedules: {len(expanded_schedules)} (batch item i uses schedule i % {len(expanded_schedules)})")
+        for sched_idx, (sched_cfgs, sched_skips, display_basis) in enumerate(expanded_schedules):
+            label_prefix = f"[Batch {sched_idx}] " if len(expanded_schedules) > 1 else ""
+            info_lines.extend(label_prefix + line for line in self._format_schedule_lines(
+                display_basis, sched_cfgs, sched_skips, initial_cfg, effective_loop_length, allow_overshoot_and_trim, num_schedule_values))
+
+        info_lines.append("Schedule Context: Attached to passthrough_model_out (per sampler run)")
+
+        if profile_steps:
+            profile_records = self._profiler.drain()
+            info_lines.append(f"Profile (previous run): {CFGStepProfiler.summarize(profile_records)}")
+            if profile_records:
+                info_lines.append(f"Profile Records ({profile_format}, last {len(profile_records)} calls):")
+                info_lines.append(CFGStepProfiler.format_records(profile_records, profile_format))
         
         print(f"[{node_class_name}] Schedule set. ({step_source_info}, {'Interpolated' if interpolate else 'Stepped'}, "
               f"{num_schedule_values} values, {loop_info_str.lower()}, {overshoot_mode_str.lower()})")
         
-        return ("\n".join(info_lines), passthrough_model, sigmas)
+        return ("\n".join(info_lines), scheduled_model, sigmas)
 
     @classmethod
     def IS_CHANGED(cls, *args, **kwargs):
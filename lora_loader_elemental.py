@@ -1,12 +1,112 @@
 import torch
-import comfy.utils
 import folder_paths
 import comfy.sd
-from safetensors.torch import safe_open, save_file
+from .lora_utils import LazyLoraFile, processed_lora_cache, save_lora_file, CACHE_MODES
 import json
 import io
 import os
 import re
+import collections
+
+STRENGTH_MAP_CACHE_SIZE = 32
+LORA_WEIGHT_SUFFIXES = (".lora_down.weight", ".lora_up.weight")
+
+TEXT_ENCODER_BLOCK = ("BASE", r"lora_te\d*_.*")
+
+def _unet_block(name, *alternatives):
+    return (name, r"lora_unet_(" + "|".join(alternatives) + r")_.*")
+
+BLOCK_WEIGHT_PRESETS = {
+    "SD1.5 (17 blocks)": [TEXT_ENCODER_BLOCK]
+        + [_unet_block(f"IN{in_idx:02d}", rf"down_blocks_{down_idx}_(attentions|resnets)_{sub_idx}")
+           for in_idx, down_idx, sub_idx in ((1, 0, 0), (2, 0, 1), (4, 1, 0), (5, 1, 1), (7, 2, 0), (8, 2, 1))]
+        + [_unet_block("MID", "mid_block")]
+        + [_unet_block(f"OUT{out_idx:02d}", rf"up_blocks_{out_idx // 3}_(attentions|resnets)_{out_idx % 3}")
+           for out_idx in range(3, 12)],
+    "SDXL (12 blocks)": [TEXT_ENCODER_BLOCK]
+        + [_unet_block(f"IN{in_idx:02d}", f"input_blocks_{in_idx}", rf"down_blocks_{down_idx}_(attentions|resnets)_{sub_idx}")
+           for in_idx, down_idx, sub_idx in ((4, 1, 0), (5, 1, 1), (7, 2, 0), (8, 2, 1))]
+        + [_unet_block("MID", "middle_block", "mid_block")]
+        + [_unet_block(f"OUT{out_idx:02d}", f"output_blocks_{out_idx}", rf"up_blocks_{out_idx // 3}_(attentions|resnets)_{out_idx % 3}")
+           for out_idx in range(6)],
+    "Flux (58 blocks)": [TEXT_ENCODER_BLOCK]
+        + [(f"DOUBLE{i:02d}", rf"(lora_unet_double_blocks_{i}|(lora_)?transformer[._]transformer_blocks[._]{i})[._].*") for i in range(19)]
+        + [(f"SINGLE{i:02d}", rf"(lora_unet_single_blocks_{i}|(lora_)?transformer[._]single_transformer_blocks[._]{i})[._].*") for i in range(38)],
+}
+
+
+class StrengthRuleMatcher:
+    def __init__(self, lora_strengths, regex_mode=False):
+        self.regex_mode = regex_mode
+        self.rules = sorted(((index, key, strength) for key, (strength, index) in lora_strengths.items()), reverse=True)
+        self._trie = None
+        self._regex_segments = []
+        if regex_mode:
+            self._compile_regex_rules()
+        else:
+            self._build_prefix_trie()
+
+    def _build_prefix_trie(self):
+        self._trie = {}
+        for index, key, strength in self.rules:
+            node = self._trie
+            for char in key:
+                node = node.setdefault(char, {})
+            if None not in node:
+                node[None] = (strength, index)
+
+    def _compile_regex_rules(self):
+        pending = []
+        for position, (index, pattern, strength) in enumerate(self.rules):
+            try:
+                compiled = re.compile(pattern)
+            except re.error as e:
+                print(f"Invalid regular expression '{pattern}': {e}")
+                continue
+            if compiled.groups:
+                self._add_regex_segment(pending)
+                self._regex_segments.append((compiled, None, (strength, index)))
+            else:
+                pending.append((position, compiled, (strength, index)))
+        self._add_regex_segment(pending)
+
+    def _add_regex_segment(self, pending):
+        if not pending:
+            return
+        group_strengths = {f"_rule{position}": rule for position, _, rule in pending}
+        try:
+            combined = re.compile("|".join(f"(?P<_rule{position}>{compiled.pattern})" for position, compiled, _ in pending))
+            self._regex_segments.append((combined, group_strengths, None))
+        except re.error:
+            self._regex_segments.extend((compiled, None, rule) for _, compiled, rule in pending)
+        pending.clear()
+
+    def match(self, lora_key):
+        if self._trie is not None:
+            node = self._trie
+            best = node.get(None)
+            for char in lora_key:
+                node = node.get(char)
+                if node is None:
+                    break
+                terminal = node.get(None)
+                if terminal is not None and (best is None or terminal[1] > best[1]):
+                    best = terminal
+            return best
+
+        for compiled, group_strengths, rule in self._regex_segments:
+            m = compiled.fullmatch(lora_key)
+            if m is not None:
+                return rule if group_strengths is None else group_strengths[m.lastgroup]
+        return None
+
+    def build_strength_map(self, lora_keys):
+        strength_map = {}
+        for lora_key in lora_keys:
+            rule = self.match(lora_key)
+            if rule is not None:
+                strength_map[lora_key] = rule
+        return strength_map
 
 
 class LoraLoaderElemental:
@@ -27,6 +127,10 @@ class LoraLoaderElemental:
                 "remove_unspecified_keys": ("BOOLEAN", {"default": False}),
                 "remove_zero_strength_keys": ("BOOLEAN", {"default": False}),  
                 "regex_mode": ("BOOLEAN", {"default": False}),
+                "block_weight_preset": (["None"] + list(BLOCK_WEIGHT_PRESETS.keys()), {"default": "None"}),
+                "block_weights": ("STRING", {"default": ""}),
+                "cache_mode": (CACHE_MODES, {"default": "RAM"}),
+                "background_save": ("BOOLEAN", {"default": True}),
             }
         }
 
@@ -41,6 +145,8 @@ class LoraLoaderElemental:
     FUNCTION = "load_lora"
     CATEGORY = "tksw_node"
 
+    _strength_map_cache = collections.OrderedDict()
+
     def _parse_strength_string(self, strength_string):
         lora_strengths = {}  
         with io.StringIO(strength_string) as f:
@@ -56,109 +162,183 @@ class LoraLoaderElemental:
                         print(f"Invalid line in strength string: ")
         return lora_strengths
 
-    def _save_processed_lora(self, lora, save_name):
+    def _parse_block_weights(self, block_weight_preset, block_weights):
+        blocks = BLOCK_WEIGHT_PRESETS.get(block_weight_preset)
+        if not blocks or not block_weights.strip():
+            return {}
+        try:
+            weights = [float(w.strip()) for w in block_weights.split(",") if w.strip()]
+        except ValueError:
+            print(f"Invalid block weights: '{block_weights}'. Ignoring block weight preset.")
+            return {}
+        if len(weights) != len(blocks):
+            print(f"Block weight preset '{block_weight_preset}' expects {len(blocks)} weights, got {len(weights)}. "
+                  f"Applying the first {min(len(weights), len(blocks))}.")
+        return {pattern: (weight, block_idx - len(blocks))
+                for block_idx, ((_, pattern), weight) in enumerate(zip(blocks, weights))}
+
+    def _get_strength_map(self, lora_path, lora_keys, lora_strength_string, regex_mode,
+                          block_weight_preset="None", block_weights=""):
+        try:
+            stat = os.stat(lora_path)
+            file_id = (lora_path, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            file_id = None
+        cache_key = (file_id, lora_strength_string, bool(regex_mode), block_weight_preset, block_weights) if file_id is not None else None
+        cache = LoraLoaderElemental._strength_map_cache
+
+        if cache_key is not None and cache_key in cache:
+            cache.move_to_end(cache_key)
+            return cache[cache_key]
+
+        strength_map = {}
+        block_rules = self._parse_block_weights(block_weight_preset, block_weights)
+        if block_rules:
+            strength_map.update(StrengthRuleMatcher(block_rules, regex_mode=True).build_strength_map(lora_keys))
+        if lora_strength_string:
+            lora_strengths = self._parse_strength_string(lora_strength_string)
+            strength_map.update(StrengthRuleMatcher(lora_strengths, regex_mode).build_strength_map(lora_keys))
+
+        if cache_key is not None:
+            cache[cache_key] = strength_map
+            while len(cache) > STRENGTH_MAP_CACHE_SIZE:
+                cache.popitem(last=False)
+        return strength_map
+
+    def _resolve_module_strengths(self, strength_map):
+        module_rules = {}
+        for key, rule in strength_map.items():
+            if not key.endswith(LORA_WEIGHT_SUFFIXES):
+                continue
+            module = key.rsplit(".lora_", 1)[0]
+            current = module_rules.get(module)
+            if current is None or rule[1] > current[1]:
+                module_rules[module] = rule
+        return {module: rule[0] for module, rule in module_rules.items()}
+
+    def _save_processed_lora(self, lora, save_name, background_save=False):
         if not save_name.endswith(".safetensors"):
             save_name += ".safetensors"
         lora_path = os.path.join(folder_paths.get_folder_paths("loras")[0], save_name)
 
-        metadata = lora.pop("metadata", {}) if isinstance(lora, dict) else {}
-        try:
-            save_file(lora, lora_path, metadata)
-            print(f"Processed LoRA saved to: {lora_path}") 
-        except Exception as e:
-            print(f"Error saving processed LoRA: {e}")  
-        if metadata:
-            lora["metadata"] = metadata
+        tensors = {k: v for k, v in lora.items() if k != "metadata"}
+        metadata = lora.get("metadata")
+        save_lora_file(tensors, lora_path, metadata if isinstance(metadata, dict) else None,
+                       background=background_save, label="Processed LoRA")
 
     def _get_lora_keys_string(self, lora):
-        if not isinstance(lora, dict):
+        if not isinstance(lora, (dict, LazyLoraFile)):
             return ""
 
         prefixes = sorted(list(set(key.split(".")[0] for key in lora if key != "metadata")))
         return "\n".join(prefixes)
 
-    def load_lora(self, lora_name, strength_model, strength_clip, model=None, clip=None,
-                 lora_strength_string="", save_lora=False, save_name="processed_lora",
-                 remove_unspecified_keys=False, remove_zero_strength_keys=False, regex_mode=False): 
-
-        lora_path = folder_paths.get_full_path_or_raise("loras", lora_name)
-
-        if model is None and clip is None:
-            raise ValueError("Either 'model' or 'clip' must be provided.")
-
-        if strength_model == 0 and strength_clip == 0:
-            try:
-                with safe_open(lora_path, framework="pt", device="cpu") as f:
-                    lora_metadata = f.metadata()
-                lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
-            except Exception as e:
-                print(f"Error reading LoRA metadata or loading: {e}") 
-                lora_metadata = {}
-                lora = {}
-            lora_keys_string = self._get_lora_keys_string(lora)
-            return (model, clip, None, json.dumps(lora_metadata, indent=4), lora_keys_string)
-
+    def _build_processed_lora(self, lora_path, lora_strength_string, regex_mode, remove_unspecified_keys,
+                              remove_zero_strength_keys, block_weight_preset, block_weights):
         try:
-            with safe_open(lora_path, framework="pt", device="cpu") as f:
-                lora_metadata = f.metadata()
-            lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
+            lora = LazyLoraFile(lora_path)
+            lora_metadata = lora.metadata
 
         except Exception as e:
             print(f"Error loading LoRA file: {e}") 
-            return (model, clip, None, None, "")
-
-        lora_strengths = {}
-        if lora_strength_string:
-            lora_strengths = self._parse_strength_string(lora_strength_string)
+            return None
 
         extended_lora = {}
-        for key, value in lora.items():
+        for key in lora.keys():
             if key == "metadata":
-                extended_lora[key] = {"value": value}
+                extended_lora[key] = {"value": lora.get_tensor(key)}
             elif key.endswith((".lora_down.weight", ".lora_up.weight")):
                 extended_lora[key] = {"strength": None, "specified": False}
             else:
                 extended_lora[key] = {"strength": None, "specified": False}
 
-        for strength_key, (strength, index) in lora_strengths.items():
-            for lora_key in list(extended_lora.keys()):
-                if regex_mode:
-                    try:
-                        if re.fullmatch(strength_key, lora_key):
-                            extended_lora[lora_key]["strength"] = strength
-                            extended_lora[lora_key]["specified"] = True
-                    except re.error as e:
-                        print(f"Invalid regular expression '{strength_key}': {e}")
-                        continue
-                else:
-                    if lora_key.startswith(strength_key):
-                        extended_lora[lora_key]["strength"] = strength
-                        extended_lora[lora_key]["specified"] = True
+        strength_map = {}
+        if lora_strength_string or block_weight_preset in BLOCK_WEIGHT_PRESETS:
+            strength_map = self._get_strength_map(lora_path, lora.keys(), lora_strength_string, regex_mode,
+                                                  block_weight_preset, block_weights)
+            for lora_key, (strength, _) in strength_map.items():
+                extended_lora[lora_key]["strength"] = strength
+                extended_lora[lora_key]["specified"] = True
+        module_strengths = self._resolve_module_strengths(strength_map)
 
         new_lora = {}
-        for key, data in extended_lora.items():
-            if key == "metadata":
-                new_lora[key] = data["value"]
+        with lora:
+            for key, data in extended_lora.items():
+                if key == "metadata":
+                    new_lora[key] = data["value"]
+                    continue
+
+                if key.endswith(LORA_WEIGHT_SUFFIXES):
+                    if data["specified"]:
+                        if remove_zero_strength_keys and module_strengths[key.rsplit(".lora_", 1)[0]] == 0: 
+                            continue
+                        new_lora[key] = lora.get_tensor(key)
+
+                    elif not remove_unspecified_keys:
+                        new_lora[key] = lora.get_tensor(key)
+                else:  
+                    if not remove_unspecified_keys:
+                        new_lora[key] = lora.get_tensor(key)
+
+        for module, strength in module_strengths.items():
+            down_key = f"{module}.lora_down.weight"
+            if strength == 1.0 or down_key not in new_lora:
                 continue
+            alpha_key = f"{module}.alpha"
+            base_alpha = new_lora[alpha_key].item() if alpha_key in new_lora else float(new_lora[down_key].shape[0])
+            new_lora[alpha_key] = torch.tensor(base_alpha * strength, dtype=torch.float32)
+
+        return new_lora, lora_metadata
+
+    def load_lora(self, lora_name, strength_model, strength_clip, model=None, clip=None,
+                 lora_strength_string="", save_lora=False, save_name="processed_lora",
+                 remove_unspecified_keys=False, remove_zero_strength_keys=False, regex_mode=False,
+                 block_weight_preset="None", block_weights="", cache_mode="RAM", background_save=True): 
 
-            if key.endswith((".lora_down.weight", ".lora_up.weight")):
-                if data["specified"]:
-                    if remove_zero_strength_keys and data["strength"] == 0: 
-                        continue
-                    new_lora[key] = lora[key] * data["strength"]
+        lora_path = folder_paths.get_full_path_or_raise("loras", lora_name)
+
+        if model is None and clip is None:
+            raise ValueError("Either 'model' or 'clip' must be provided.")
 
-                elif not remove_unspecified_keys:
-                    new_lora[key] = lora[key]
-            else:  
-                if not remove_unspecified_keys:
-                    new_lora[key] = lora[key]
+        if strength_model == 0 and strength_clip == 0:
+            try:
+                with LazyLoraFile(lora_path) as lora_file:
+                    lora_metadata = lora_file.metadata
+                    lora_keys_string = self._get_lora_keys_string(lora_file)
+            except Exception as e:
+                print(f"Error reading LoRA metadata or loading: {e}") 
+                lora_metadata = {}
+                lora_keys_string = ""
+            return (model, clip, None, json.dumps(lora_metadata, indent=4), lora_keys_string)
+
+        cache_key = None
+        use_disk_cache = cache_mode == "RAM + Disk"
+        if cache_mode != "Off":
+            try:
+                cache_key = processed_lora_cache.make_key(
+                    "LoraLoaderElemental", [lora_path],
+                    (lora_strength_string, bool(regex_mode), bool(remove_unspecified_keys),
+                     bool(remove_zero_strength_keys), block_weight_preset, block_weights))
+            except OSError:
+                cache_key = None
 
+        cached = processed_lora_cache.get(cache_key, use_disk_cache) if cache_key is not None else None
+        if cached is not None:
+            new_lora, lora_metadata = cached
+        else:
+            processed = self._build_processed_lora(lora_path, lora_strength_string, regex_mode, remove_unspecified_keys,
+                                                   remove_zero_strength_keys, block_weight_preset, block_weights)
+            if processed is None:
+                return (model, clip, None, None, "")
+            new_lora, lora_metadata = processed
+            if cache_key is not None:
+                processed_lora_cache.put(cache_key, new_lora, lora_metadata, use_disk_cache)
 
         model_lora, clip_lora = comfy.sd.load_lora_for_models(model, clip, new_lora, strength_model, strength_clip)
         lora_metadata_string = json.dumps(lora_metadata, indent=4)
 
         if save_lora:
-            self._save_processed_lora(new_lora, save_name)
+            self._save_processed_lora(new_lora, save_name, background_save)
 
         lora_keys_string = self._get_lora_keys_string(new_lora)
 
@@ -1,14 +1,18 @@
 import torch
-import comfy.utils
 import folder_paths
 import comfy.sd
+import comfy.lora
+import comfy.model_management
 from safetensors.torch import safe_open
-import random
+import numpy as np
 import os
 import json
+from .lora_utils import processed_lora_cache, save_lora_file, LazyLoraFile, fuse_lora_parts, CACHE_MODES, TORCH_DTYPES
+from .rng_utils import node_rng
 
 class LoraMixerElemental:
     MAX_LORAS = 8
+    MERGE_BATCH_ELEMENTS = 1 << 22
 
     @classmethod
     def INPUT_TYPES(cls):
@@ -33,7 +37,16 @@ class LoraMixerElemental:
             "optional": {
                 "model": ("MODEL",),
                 "clip": ("CLIP",),
-            }
+                "cache_mode": (CACHE_MODES, {"default": "RAM"}),
+                "background_save": ("BOOLEAN", {"default": True}),
+                "fuse_passes": ("BOOLEAN", {"default": False}),
+                "additional_loras": ("STRING", {"multiline": True, "default": ""}),
+                "merge_mode": (["Select", "SVD Merge"], {"default": "Select"}),
+                "merge_rank": ("INT", {"default": 32, "min": 1, "max": 1024}),
+                "merge_weights": ("STRING", {"default": ""}),
+                "merge_device": (["CPU", "GPU"], {"default": "CPU"}),
+            },
+            "hidden": {"unique_id": "UNIQUE_ID"},
         }
         for i in range(1, cls.MAX_LORAS + 1):
             input_types["optional"][f"lora_name_{i}"] = (lora_names, {"default": "None"})
@@ -48,124 +61,309 @@ class LoraMixerElemental:
     FUNCTION = "mix_loras"
     CATEGORY = "tksw_node"
 
-    def mix_loras(self, model_strength, clip_strength, seed, save_mixed_lora, save_name, key_selection,
-                  key_strength_randomization, key_strength_min, key_strength_max, multi_mix, num_mix_passes,
-                  mix_passes_strength_randomization, mix_pass_strength_min, mix_pass_strength_max, model=None, clip=None, **kwargs):
-
-        if model is None and clip is None:
-            raise ValueError("Either 'model' or 'clip' must be provided.")
-
-        lora_names = [
-            kwargs[key] for key in kwargs
-            if key.startswith("lora_name_") and kwargs[key] != "None"
-        ]
-        if not lora_names:
-            return (model, clip, None, "", "{}") 
-
+    def _build_compatibility_index(self, loras, common_only):
+        module_sets = []
+        for lora in loras:
+            module_sets.append({key[:-len(".lora_down.weight")] for key in lora.keys() if key.endswith(".lora_down.weight")}
+                               | {key[:-len(".lora_up.weight")] for key in lora.keys() if key.endswith(".lora_up.weight")})
+        if common_only:
+            modules = set.intersection(*module_sets)
+        else:
+            modules = set.union(*module_sets)
+        modules = sorted(modules)
+
+        down_rank = np.full((len(modules), len(loras)), -1, dtype=np.int64)
+        up_rank = np.full((len(modules), len(loras)), -1, dtype=np.int64)
+        up_shape = np.full((len(modules), len(loras)), -1, dtype=np.int64)
+        up_shape_ids = {}
+        for s_idx, lora in enumerate(loras):
+            for m_idx, module in enumerate(modules):
+                down_key = f"{module}.lora_down.weight"
+                up_key = f"{module}.lora_up.weight"
+                if down_key in lora:
+                    down_rank[m_idx, s_idx] = lora.shape(down_key)[0]
+                if up_key in lora and len(lora.shape(up_key)) > 1:
+                    up_rank[m_idx, s_idx] = lora.shape(up_key)[1]
+                    up_shape[m_idx, s_idx] = up_shape_ids.setdefault(tuple(lora.shape(up_key)), len(up_shape_ids))
+        if common_only:
+            complete = ((down_rank >= 0) & (up_rank >= 0)).all(axis=1)
+            keep = np.flatnonzero(complete)
+            modules = [modules[i] for i in keep]
+            down_rank, up_rank, up_shape = down_rank[keep], up_rank[keep], up_shape[keep]
+        return modules, down_rank, up_rank, up_shape
+
+    def _draw_sources(self, rng, candidates):
+        counts = candidates.sum(axis=1)
+        picks = np.floor(rng.random(len(counts)) * counts).astype(np.int64)
+        choice = np.argmax(np.cumsum(candidates, axis=1) > picks[:, None], axis=1)
+        return np.where(counts > 0, choice, -1)
+
+    def _parse_merge_weights(self, merge_weights, source_count):
+        weights = [1.0 / source_count] * source_count
+        if merge_weights.strip():
+            try:
+                values = [float(w.strip()) for w in merge_weights.split(",") if w.strip()]
+            except ValueError:
+                print(f"Invalid merge weights: '{merge_weights}'. Using equal weights.")
+                return weights
+            if len(values) != source_count:
+                print(f"Merge weights count ({len(values)}) does not match the number of LoRAs ({source_count}). "
+                      f"Missing weights are set to 0.")
+            weights = (values + [0.0] * source_count)[:source_count]
+        return weights
+
+    def _svd_merge(self, loras, source_names, modules, down_rank, up_rank, key_strengths, merge_rank, merge_weights, merge_device):
+        weights = self._parse_merge_weights(merge_weights, len(loras))
+        device = comfy.model_management.get_torch_device() if merge_device == "GPU" else torch.device("cpu")
+
+        shape_groups = {}
+        for m_idx, module in enumerate(modules):
+            down_key = f"{module}.lora_down.weight"
+            up_key = f"{module}.lora_up.weight"
+            sources = [s_idx for s_idx in range(len(loras))
+                       if down_rank[m_idx, s_idx] >= 0 and down_rank[m_idx, s_idx] == up_rank[m_idx, s_idx]
+                       and weights[s_idx] != 0]
+            if not sources or key_strengths[m_idx] == 0:
+                continue
+            out_dim = loras[sources[0]].shape(up_key)[0]
+            down_tail = loras[sources[0]].shape(down_key)[1:]
+            sources = [s_idx for s_idx in sources
+                       if loras[s_idx].shape(down_key)[1:] == down_tail and loras[s_idx].shape(up_key)[0] == out_dim
+                       and int(np.prod(loras[s_idx].shape(up_key)[2:])) == 1]
+            if not sources:
+                continue
+            total_rank = int(down_rank[m_idx, sources].sum())
+            shape_groups.setdefault((out_dim, down_tail, total_rank), []).append((m_idx, sources))
+
+        merged_lora = {}
+        key_source_map = {}
+        for (out_dim, down_tail, total_rank), items in shape_groups.items():
+            in_dim = int(np.prod(down_tail))
+            chunk_len = max(1, self.MERGE_BATCH_ELEMENTS // ((out_dim + in_dim) * total_rank))
+            for start in range(0, len(items), chunk_len):
+                chunk = items[start:start + chunk_len]
+                ups, downs = [], []
+                for m_idx, sources in chunk:
+                    module = modules[m_idx]
+                    module_ups, module_downs = [], []
+                    for s_idx in sources:
+                        lora = loras[s_idx]
+                        rank = int(down_rank[m_idx, s_idx])
+                        alpha_key = f"{module}.alpha"
+                        scale = lora.get_tensor(alpha_key).item() / rank if alpha_key in lora else 1.0
+                        scale *= weights[s_idx] * float(key_strengths[m_idx])
+                        module_ups.append(lora.get_tensor(f"{module}.lora_up.weight").to(device, torch.float32).reshape(out_dim, rank) * scale)
+                        module_downs.append(lora.get_tensor(f"{module}.lora_down.weight").to(device, torch.float32).reshape(rank, in_dim))
+                    ups.append(torch.cat(module_ups, dim=1))
+                    downs.append(torch.cat(module_downs, dim=0))
+
+                q_up, r_up = torch.linalg.qr(torch.stack(ups))
+                q_down, r_down = torch.linalg.qr(torch.stack(downs).transpose(1, 2))
+                u, sigma, vh = torch.linalg.svd(r_up @ r_down.transpose(1, 2), full_matrices=False)
+                rank = min(merge_rank, sigma.shape[1])
+                sqrt_sigma = sigma[:, :rank].sqrt()
+                new_ups = ((q_up @ u[:, :, :rank]) * sqrt_sigma[:, None, :]).cpu()
+                new_downs = ((sqrt_sigma[:, :, None] * vh[:, :rank, :]) @ q_down.transpose(1, 2)).cpu()
+
+                for i, (m_idx, sources) in enumerate(chunk):
+                    module = modules[m_idx]
+                    dtype = TORCH_DTYPES[loras[sources[0]].dtype(f"{module}.lora_down.weight")]
+                    up_shape = (out_dim, rank) + tuple(loras[sources[0]].shape(f"{module}.lora_up.weight")[2:])
+                    merged_lora[f"{module}.lora_down.weight"] = new_downs[i].reshape((rank,) + tuple(down_tail)).to(dtype)
+                    merged_lora[f"{module}.lora_up.weight"] = new_ups[i].reshape(up_shape).to(dtype)
+                    merged_lora[f"{module}.alpha"] = torch.tensor(float(rank))
+                    merged_from = "svd_merge(" + "+".join(source_names[s_idx] for s_idx in sources) + ")"
+                    key_source_map[f"{module}.lora_down.weight"] = merged_from
+                    key_source_map[f"{module}.lora_up.weight"] = merged_from
+
+        print(f"SVD merged {len(key_source_map) // 2} modules from {len(loras)} LoRAs to rank <= {merge_rank}.")
+        return merged_lora, key_source_map
+
+    def _build_mix_passes(self, lora_names, model_strength, clip_strength, seed, key_selection,
+                          key_strength_randomization, key_strength_min, key_strength_max, multi_mix, num_mix_passes,
+                          mix_passes_strength_randomization, mix_pass_strength_min, mix_pass_strength_max,
+                          merge_mode="Select", merge_rank=32, merge_weights="", merge_device="CPU", node_id=None):
         loras = []
-        lora_name_map = {}
-        lora_dims = {}
+        source_names = []
 
-        for i, lora_name in enumerate(lora_names):
+        for lora_name in lora_names:
             lora_path = folder_paths.get_full_path("loras", lora_name)
             try:
-                lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
-                loras.append(lora)
-                lora_name_map[f"lora{i+1}"] = lora_name
-                lora_dims[f"lora{i+1}"] = {}
-                for key, value in lora.items():
-                    if isinstance(value, torch.Tensor):
-                        lora_dims[f"lora{i+1}"][key] = value.shape
+                loras.append(LazyLoraFile(lora_path))
+                source_names.append(lora_name)
             except Exception as e:
                 print(f"Error loading LoRA {lora_name}: {e}")
                 continue
 
         if not loras:
-             return (model, clip, None, "", "{}")
-
-        if key_selection == "Common Keys Only":
-            common_keys = set(loras[0].keys())
-            for lora in loras[1:]:
-                common_keys.intersection_update(lora.keys())
-            filtered_keys = {key for key in common_keys if key.endswith((".lora_down.weight", ".lora_up.weight"))}
-        elif key_selection == "All Available Keys":
-            all_keys = set()
-            for lora in loras:
-                all_keys.update(lora.keys())
-            filtered_keys = {key for key in all_keys if key.endswith((".lora_down.weight", ".lora_up.weight"))}
-        else:
-            raise ValueError(f"Invalid key_selection_mode: {key_selection}")
+             return None
 
-        random.seed(seed)
+        if key_selection not in ("All Available Keys", "Common Keys Only"):
+            raise ValueError(f"Invalid key_selection_mode: {key_selection}")
+        modules, down_rank, up_rank, up_shape = self._build_compatibility_index(loras, key_selection == "Common Keys Only")
+
+        fetched_tensors = {}
+
+        def fetch(index, key):
+            tensor = fetched_tensors.get((index, key))
+            if tensor is None:
+                tensor = fetched_tensors[(index, key)] = loras[index].get_tensor(key)
+            return tensor
+
+        if merge_mode == "SVD Merge":
+            rng = node_rng(seed, "LoraMixerElemental", node_id=node_id)
+            key_strengths = rng.uniform(key_strength_min, key_strength_max, len(modules))
+            if key_strength_randomization != "Per Key":
+                key_strengths = np.ones(len(modules))
+            merged_lora, key_source_map = self._svd_merge(loras, source_names, modules, down_rank, up_rank, key_strengths,
+                                                          merge_rank, merge_weights, merge_device)
+            for lora in loras:
+                lora.close()
+            return [(0, merged_lora, model_strength, clip_strength, key_source_map)] if merged_lora else []
 
-        current_model = model
-        current_clip = clip
-        first_mixed_lora = None
-        first_lora_keys_string = ""
-        all_lora_keys = {}
+        active = np.ones(len(modules), dtype=bool)
 
+        mix_passes = []
         for mix_num in range(num_mix_passes if multi_mix != "Off" else 1):
+            rng = node_rng(seed, "LoraMixerElemental", mix_num, node_id)
+            pass_active = active if multi_mix == "Reuse Keys" else active.copy()
+            has_down = (down_rank >= 0) & pass_active[:, None]
+            down_choice = self._draw_sources(rng, has_down)
+            chosen_index = np.maximum(down_choice, 0)[:, None]
+            chosen_rank = np.take_along_axis(down_rank, chosen_index, axis=1)
+            expected_shape = np.take_along_axis(up_shape, chosen_index, axis=1)
+            compatible_up = np.where(expected_shape >= 0, up_shape == expected_shape, up_rank == chosen_rank)
+            up_choice = self._draw_sources(rng, compatible_up & has_down.any(axis=1, keepdims=True))
+            key_strengths = rng.uniform(key_strength_min, key_strength_max, len(modules))
+
+            selected = (down_choice >= 0) & (up_choice >= 0)
+            pass_active &= ~((down_choice >= 0) & (up_choice < 0))
+
             mixed_lora = {}
             key_source_map = {}
+            for m in np.flatnonzero(selected):
+                module = modules[m]
+                down_key = f"{module}.lora_down.weight"
+                up_key = f"{module}.lora_up.weight"
+                selected_down_index, selected_up_index = int(down_choice[m]), int(up_choice[m])
+                if key_strength_randomization == "Per Key":
+                    strength = float(key_strengths[m])
+                    mixed_lora[down_key] = fetch(selected_down_index, down_key) * strength
+                    mixed_lora[up_key] = fetch(selected_up_index, up_key) * strength
+                else:
+                    mixed_lora[down_key] = fetch(selected_down_index, down_key)
+                    mixed_lora[up_key] = fetch(selected_up_index, up_key)
 
-            temp_filtered_keys = filtered_keys if multi_mix == "Reuse Keys" else filtered_keys.copy()
+                key_source_map[down_key] = source_names[selected_down_index]
+                key_source_map[up_key] = source_names[selected_up_index]
 
-            for down_key in list(temp_filtered_keys):
-                if not down_key.endswith(".lora_down.weight"):
-                    continue
+            if not mixed_lora:
+                continue
 
-                up_key = down_key.replace(".lora_down.weight", ".lora_up.weight")
-                if up_key not in temp_filtered_keys:
-                    continue
+            if multi_mix != "Off" and mix_passes_strength_randomization == "On":
+                mix_strength_model, mix_strength_clip = (float(v) for v in rng.uniform(mix_pass_strength_min, mix_pass_strength_max, 2))
+            else:
+                mix_strength_model = model_strength
+                mix_strength_clip = clip_strength
 
-                available_down_loras = []
-                for i, lora in enumerate(loras):
-                    if down_key in lora:
-                        available_down_loras.append((i, lora))
-                if not available_down_loras:
-                    continue
+            mix_passes.append((mix_num, mixed_lora, mix_strength_model, mix_strength_clip, key_source_map))
 
-                selected_down_index, selected_down_lora = random.choice(available_down_loras)
+        for lora in loras:
+            lora.close()
+        return mix_passes
 
-                available_up_loras = []
-                for i, lora in enumerate(loras):
-                    if up_key in lora:
-                        if lora_dims[f"lora{i+1}"][up_key] == lora_dims[f"lora{selected_down_index+1}"][up_key]:
-                            available_up_loras.append((i, lora))
+    def _fuse_mix_passes(self, mix_passes, model, clip):
+        clip_modules = set()
+        if clip is not None:
+            clip_modules = set(comfy.lora.model_lora_keys_clip(clip.cond_stage_model, {}).keys())
 
-                if not available_up_loras:
-                    temp_filtered_keys.discard(down_key)
-                    temp_filtered_keys.discard(up_key)
+        module_parts = {}
+        for _, mixed_lora, mix_strength_model, mix_strength_clip, _ in mix_passes:
+            for down_key, down in mixed_lora.items():
+                if not down_key.endswith(".lora_down.weight"):
                     continue
+                module = down_key[:-len(".lora_down.weight")]
+                up = mixed_lora.get(f"{module}.lora_up.weight")
+                if up is None:
+                    continue
+                strength = mix_strength_clip if module in clip_modules else mix_strength_model
+                if strength == 0:
+                    continue
+                module_parts.setdefault(module, []).append((down, up, strength))
 
-                selected_up_index, selected_up_lora = random.choice(available_up_loras)
+        return fuse_lora_parts(module_parts)
 
-                if key_strength_randomization == "Per Key":
-                    strength = random.uniform(key_strength_min, key_strength_max)
-                    mixed_lora[down_key] = selected_down_lora[down_key] * strength
-                    mixed_lora[up_key] = selected_up_lora[up_key] * strength
-                else:
-                    mixed_lora[down_key] = selected_down_lora[down_key]
-                    mixed_lora[up_key] = selected_up_lora[up_key]
+    def mix_loras(self, model_strength, clip_strength, seed, save_mixed_lora, save_name, key_selection,
+                  key_strength_randomization, key_strength_min, key_strength_max, multi_mix, num_mix_passes,
+                  mix_passes_strength_randomization, mix_pass_strength_min, mix_pass_strength_max, model=None, clip=None,
+                  cache_mode="RAM", background_save=True, fuse_passes=False, additional_loras="",
+                  merge_mode="Select", merge_rank=32, merge_weights="", merge_device="CPU", unique_id=None, **kwargs):
 
-                key_source_map[down_key] = lora_name_map[f"lora{selected_down_index + 1}"]
-                key_source_map[up_key] = lora_name_map[f"lora{selected_up_index + 1}"]
+        if model is None and clip is None:
+            raise ValueError("Either 'model' or 'clip' must be provided.")
 
-                if multi_mix != "Reuse Keys":
-                    temp_filtered_keys.discard(down_key)
-                    temp_filtered_keys.discard(up_key)
-            
-            if not mixed_lora:
-                continue
+        lora_names = [
+            kwargs[key] for key in kwargs
+            if key.startswith("lora_name_") and kwargs[key] != "None"
+        ]
+        lora_names += [line.strip() for line in additional_loras.splitlines() if line.strip()]
+        if not lora_names:
+            return (model, clip, None, "", "{}") 
 
-            if multi_mix != "Off" and mix_passes_strength_randomization == "On":
-                mix_strength_model = random.uniform(mix_pass_strength_min, mix_pass_strength_max)
-                mix_strength_clip = random.uniform(mix_pass_strength_min, mix_pass_strength_max)
-            else:
-                mix_strength_model = model_strength
-                mix_strength_clip = clip_strength
+        cache_key = None
+        use_disk_cache = cache_mode == "RAM + Disk"
+        if cache_mode != "Off":
+            try:
+                cache_key = processed_lora_cache.make_key(
+                    "LoraMixerElemental", [folder_paths.get_full_path("loras", name) for name in lora_names],
+                    (tuple(lora_names), model_strength, clip_strength, seed, key_selection, key_strength_randomization,
+                     key_strength_min, key_strength_max, multi_mix, num_mix_passes, mix_passes_strength_randomization,
+                     mix_pass_strength_min, mix_pass_strength_max, merge_mode, merge_rank, merge_weights, unique_id))
+            except (OSError, TypeError):
+                cache_key = None
+
+        cached = processed_lora_cache.get(cache_key, use_disk_cache) if cache_key is not None else None
+        if cached is not None:
+            tensors, pass_infos = cached
+            mix_passes = []
+            for pass_info in pass_infos:
+                prefix = f"{pass_info['mix_num']}/"
+                mixed_lora = {key[len(prefix):]: value for key, value in tensors.items() if key.startswith(prefix)}
+                mix_passes.append((pass_info["mix_num"], mixed_lora, pass_info["model_strength"],
+                                   pass_info["clip_strength"], pass_info["sources"]))
+        else:
+            mix_passes = self._build_mix_passes(lora_names, model_strength, clip_strength, seed, key_selection,
+                                                key_strength_randomization, key_strength_min, key_strength_max, multi_mix,
+                                                num_mix_passes, mix_passes_strength_randomization, mix_pass_strength_min,
+                                                mix_pass_strength_max, merge_mode, merge_rank, merge_weights, merge_device,
+                                                unique_id)
+            if mix_passes is None:
+                return (model, clip, None, "", "{}")
+            if cache_key is not None:
+                tensors = {f"{mix_num}/{key}": value for mix_num, mixed_lora, _, _, _ in mix_passes
+                           for key, value in mixed_lora.items()}
+                pass_infos = [{"mix_num": mix_num, "model_strength": mix_strength_model, "clip_strength": mix_strength_clip,
+                               "sources": key_source_map}
+                              for mix_num, _, mix_strength_model, mix_strength_clip, key_source_map in mix_passes]
+                processed_lora_cache.put(cache_key, tensors, pass_infos, use_disk_cache)
 
-            current_model, current_clip = comfy.sd.load_lora_for_models(current_model, current_clip, mixed_lora, mix_strength_model, mix_strength_clip)
+        current_model = model
+        current_clip = clip
+        first_mixed_lora = None
+        first_lora_keys_string = ""
+        all_lora_keys = {}
+
+        fuse_passes = fuse_passes and len(mix_passes) > 1
+        if fuse_passes:
+            fused_loras = self._fuse_mix_passes(mix_passes, model, clip)
+            for fused_lora in fused_loras:
+                current_model, current_clip = comfy.sd.load_lora_for_models(current_model, current_clip, fused_lora, 1.0, 1.0)
+            print(f"Fused {len(mix_passes)} mix passes into {len(fused_loras)} patch set(s) "
+                  f"({sum(len(fused_lora) for fused_lora in fused_loras) // 2} module patches).")
+
+        for mix_num, mixed_lora, mix_strength_model, mix_strength_clip, key_source_map in mix_passes:
+            if not fuse_passes:
+                current_model, current_clip = comfy.sd.load_lora_for_models(current_model, current_clip, mixed_lora, mix_strength_model, mix_strength_clip)
 
             sorted_key_source_pairs = sorted(key_source_map.items(), key=lambda item: item[0])
             all_lora_keys[f"mix_pass_{mix_num + 1}"] = {key: source for key, source in sorted_key_source_pairs}
@@ -180,22 +378,14 @@ class LoraMixerElemental:
                 if not current_save_name.endswith(".safetensors"):
                     current_save_name += ".safetensors"
                 lora_path = os.path.join(folder_paths.get_folder_paths("loras")[0], current_save_name)
-                try:
-                    lora_to_save = {k: v for k, v in mixed_lora.items() if isinstance(v, torch.Tensor)}
-                    comfy.utils.save_torch_file(lora_to_save, lora_path)
-                    print(f"Mixed LoRA {mix_num + 1} saved to: {lora_path}")
-                except Exception as e:
-                    print(f"Error saving mixed LoRA {mix_num + 1}: {e}")
+                lora_to_save = {k: v for k, v in mixed_lora.items() if isinstance(v, torch.Tensor)}
+                save_lora_file(lora_to_save, lora_path, background=background_save, label=f"Mixed LoRA {mix_num + 1}")
 
         if save_mixed_lora == "First Only" and first_mixed_lora:
             if not save_name.endswith(".safetensors"):
                 save_name += ".safetensors"
             lora_path = os.path.join(folder_paths.get_folder_paths("loras")[0], save_name)
-            try:
-                lora_to_save = {k: v for k, v in first_mixed_lora.items() if isinstance(v, torch.Tensor)}
-                comfy.utils.save_torch_file(lora_to_save,lora_path)
-                print(f"First mixed LoRA saved to: {lora_path}")
-            except Exception as e:
-                print(f"Error saving first mixed LoRA: {e}")
+            lora_to_save = {k: v for k, v in first_mixed_lora.items() if isinstance(v, torch.Tensor)}
+            save_lora_file(lora_to_save, lora_path, background=background_save, label="First mixed LoRA")
 
         return (current_model, current_clip, first_mixed_lora, first_lora_keys_string, json.dumps(all_lora_keys, indent=4))
\ No newline at end of file
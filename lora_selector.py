@@ -1,14 +1,16 @@
 import os
-import random
 import torch
-import collections
-import comfy.utils
 import comfy.sd 
 from folder_paths import get_filename_list, supported_pt_extensions, get_full_path
+from .lora_utils import load_lora_state_dict, unpack_lora, LoraTensorCache, CACHE_TIERS
+from .rng_utils import node_choice
 
 LORA_SLOT_COUNT = 8
 LORA_EXTENSIONS = [ext.lower() for ext in supported_pt_extensions]
 
+def _load_lora_data(lora_path):
+    return load_lora_state_dict(lora_path, keep_packed=True)
+
 class LoraSelector:
     def __init__(self):
         self.round_robin_index = 0
@@ -17,9 +19,8 @@ class LoraSelector:
         self.cached_folder_loras = []
         self.current_lora = None
         self.remaining_executions = 0
-        self.loaded_lora_cache = collections.OrderedDict()
-        self.lora_size_cache = {}
-        self.current_cache_size_bytes = 0
+        self.random_switch_index = 0
+        self.lora_cache = LoraTensorCache()
 
     @classmethod
     def INPUT_TYPES(cls):
@@ -39,6 +40,8 @@ class LoraSelector:
             "optional": {
                  "model": ("MODEL",),
                  "clip": ("CLIP",),
+                 "cache_tier": (CACHE_TIERS, {"default": "CPU"}),
+                 "prefetch": ("BOOLEAN", {"default": True}),
             }
         }
         return inputs
@@ -66,7 +69,25 @@ class LoraSelector:
             print(f"[LoraSelector] Error scanning folder '{folder_path}': {e}")
             return []
 
-    def select_and_apply_lora(self, strength_model, strength_clip, mode, switch_interval, seed, reset_state, cache_limit_gb, lora_folder, model=None, clip=None, **kwargs):
+    def _predict_next_lora(self, mode, seed, candidate_loras):
+        if mode == "round-robin":
+            return candidate_loras[self.round_robin_index % len(candidate_loras)]
+        if mode == "random":
+            available_choices = [lora for lora in candidate_loras if lora != self.current_lora] or candidate_loras
+            return node_choice(seed, "LoraSelector", available_choices, stream=self.random_switch_index)
+        return None
+
+    def _prefetch_next_lora(self, mode, seed, candidate_loras, current_path):
+        if self.remaining_executions > 0:
+            return
+        next_lora = self._predict_next_lora(mode, seed, candidate_loras)
+        if next_lora is None or next_lora == self.current_lora:
+            return
+        lora_path = get_full_path("loras", next_lora)
+        if lora_path and self.lora_cache.prefetch(lora_path, _load_lora_data, keep_path=current_path) is not None:
+            print(f"[LoraSelector] Prefetching next LoRA: '{next_lora}'")
+
+    def select_and_apply_lora(self, strength_model, strength_clip, mode, switch_interval, seed, reset_state, cache_limit_gb, lora_folder, model=None, clip=None, cache_tier="CPU", prefetch=True, **kwargs):
         current_folder_loras = []
         clean_lora_folder = lora_folder.strip()
         if clean_lora_folder:
@@ -107,11 +128,10 @@ class LoraSelector:
                 self.current_lora = None
                 self.remaining_executions = 0
                 self.round_robin_index = 0
+                self.random_switch_index = 0
                 if reset_state:
                      print("[LoraSelector] Clearing LoRA data cache due to manual reset.")
-                     self.loaded_lora_cache.clear()
-                     self.lora_size_cache.clear()
-                     self.current_cache_size_bytes = 0
+                     self.lora_cache.clear()
                 self.last_candidate_list = list(candidate_loras) 
             else:
                  if self.last_candidate_list is None or candidate_loras != self.last_candidate_list:
@@ -130,15 +150,14 @@ class LoraSelector:
                     self.round_robin_index += 1
                     print(f"[LoraSelector] Mode: round-robin switch (Index: {current_index}, Next RR Base: {self.round_robin_index})")
                 elif mode == "random":
-                    random.seed(seed)
                     available_choices = [lora for lora in candidate_loras if lora != self.current_lora]
                     if not available_choices and num_candidates > 0: available_choices = candidate_loras
-                    chosen_lora = random.choice(available_choices)
+                    chosen_lora = node_choice(seed, "LoraSelector", available_choices, stream=self.random_switch_index)
+                    self.random_switch_index += 1
                     print(f"[LoraSelector] Mode: random switch (Seed: {seed})")
                 else:
                     print(f"[LoraSelector] Warning: Unknown mode '{mode}'. Falling back to random.")
-                    random.seed(seed)
-                    chosen_lora = random.choice(candidate_loras)
+                    chosen_lora = node_choice(seed, "LoraSelector", candidate_loras)
 
                 self.current_lora = chosen_lora
                 self.remaining_executions = current_switch_interval - 1
@@ -148,7 +167,7 @@ class LoraSelector:
             output_model = model
             output_clip = clip
             cache_enabled = cache_limit_gb > 0
-            cache_limit_bytes = int(cache_limit_gb * (1024**3)) if cache_enabled else 0
+            self.lora_cache.configure(int(cache_limit_gb * (1024**3)), cache_tier)
 
             if chosen_lora:
                 selected_lora_name = chosen_lora
@@ -162,55 +181,26 @@ class LoraSelector:
                 print(f"[LoraSelector] Effective Strength - Model: {effective_strength_model if model else 'N/A'}, Clip: {effective_strength_clip if clip else 'N/A'}")
 
                 try:
-                    lora_data = None
-                    cache_hit = False
-
-                    if cache_enabled and chosen_lora in self.loaded_lora_cache:
-                        lora_data = self.loaded_lora_cache[chosen_lora]
-                        self.loaded_lora_cache.move_to_end(chosen_lora)
-                        print(f"[LoraSelector] Using cached LoRA data for '{chosen_lora}'. Cache Size: {self.current_cache_size_bytes / (1024**3):.2f}/{cache_limit_gb:.1f} GB")
-                        cache_hit = True
-
-                    if not cache_hit:
-                        lora_path = get_full_path("loras", chosen_lora)
-                        if not lora_path:
-                            raise FileNotFoundError(f"LoRA file not found in known paths: {chosen_lora}")
+                    lora_path = get_full_path("loras", chosen_lora)
+                    if not lora_path:
+                        raise FileNotFoundError(f"LoRA file not found in known paths: {chosen_lora}")
 
+                    if cache_enabled:
+                        lora_data = self.lora_cache.load(lora_path, _load_lora_data)
+                        print(f"[LoraSelector] LoRA data for '{chosen_lora}' ready. Cache: {self.lora_cache.format_stats()}")
+                    else:
                         print(f"[LoraSelector] Loading LoRA data from: {lora_path}")
-                        lora_data = comfy.utils.load_torch_file(lora_path, safe_load=True)
-
-                        if cache_enabled and lora_data is not None:
-                            try:
-                                lora_file_size = os.path.getsize(lora_path)
-
-                                while self.current_cache_size_bytes + lora_file_size > cache_limit_bytes and self.loaded_lora_cache:
-                                    oldest_key, _ = self.loaded_lora_cache.popitem(last=False)
-                                    removed_size = self.lora_size_cache.pop(oldest_key, 0) # サイズ情報も削除
-                                    self.current_cache_size_bytes -= removed_size
-                                    print(f"[LoraSelector] Cache evicted '{oldest_key}' (Size: {removed_size / (1024**2):.1f} MB) to make space. New Size: {self.current_cache_size_bytes / (1024**3):.2f}/{cache_limit_gb:.1f} GB")
-
-                                if self.current_cache_size_bytes + lora_file_size <= cache_limit_bytes:
-                                    self.loaded_lora_cache[chosen_lora] = lora_data 
-                                    self.lora_size_cache[chosen_lora] = lora_file_size 
-                                    self.current_cache_size_bytes += lora_file_size
-                                    print(f"[LoraSelector] Cached LoRA data for '{chosen_lora}'. Cache Size: {self.current_cache_size_bytes / (1024**3):.2f}/{cache_limit_gb:.1f} GB. Items: {len(self.loaded_lora_cache)}")
-                                else:
-                                    print(f"[LoraSelector] Warning: LoRA '{chosen_lora}' (Size: {lora_file_size / (1024**2):.1f} MB) is too large for cache limit ({cache_limit_gb:.1f} GB). Not caching.")
-                            except FileNotFoundError:
-                                print(f"[LoraSelector] Warning: Could not get file size for '{lora_path}'. Caching without size check might be unreliable.")
-                                if cache_enabled: 
-                                     self.loaded_lora_cache[chosen_lora] = lora_data
-                                     print(f"[LoraSelector] Cached LoRA data for '{chosen_lora}' (size unknown).")
-                            except Exception as e:
-                                print(f"[LoraSelector] Error during cache management for '{chosen_lora}': {e}")
+                        lora_data = _load_lora_data(lora_path)
 
                     if lora_data is not None:
                          applied_model, applied_clip = comfy.sd.load_lora_for_models(
-                             output_model, output_clip, lora_data,
+                             output_model, output_clip, unpack_lora(*lora_data),
                              effective_strength_model, effective_strength_clip
                          )
                          output_model = applied_model
                          output_clip = applied_clip
+                         if cache_enabled and prefetch:
+                             self._prefetch_next_lora(mode, seed, candidate_loras, lora_path)
                     else:
                          print(f"[LoraSelector] Warning: LoRA data for '{chosen_lora}' is None. Skipping application.")
 
@@ -0,0 +1,623 @@
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import struct
+import threading
+import numpy as np
+import torch
+import comfy.utils
+import comfy.model_management
+from safetensors import safe_open
+from safetensors.torch import load_file
+
+PROCESSED_LORA_RAM_BYTES = 4 * 1024 ** 3
+PROCESSED_LORA_DISK_BYTES = 16 * 1024 ** 3
+PROCESSED_LORA_DISK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lora_cache")
+CACHE_MODES = ["RAM", "RAM + Disk", "Off"]
+CACHE_TIERS = ["CPU", "Pinned CPU", "GPU"]
+
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+for _name, _code in (("float8_e4m3fn", "F8_E4M3"), ("float8_e5m2", "F8_E5M2")):
+    if hasattr(torch, _name):
+        SAFETENSORS_DTYPES[getattr(torch, _name)] = _code
+TORCH_DTYPES = {code: dtype for dtype, code in SAFETENSORS_DTYPES.items()}
+
+PACKED_LORA_FORMAT = "tksw_packed_v1"
+PACKED_LORA_METADATA_KEY = "tksw_quantization"
+PACKED_PART_SUFFIXES = (".qweight", ".qscale", ".qzero")
+
+
+def is_safetensors_file(path):
+    return path.lower().endswith(".safetensors")
+
+def read_safetensors_header(path):
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    metadata = header.pop("__metadata__", None)
+    return header, metadata
+
+
+def quantization_layout(shape, granularity, group_size):
+    numel = 1
+    for dim in shape:
+        numel *= dim
+    channels = shape[0] if granularity != "Per Tensor" and len(shape) > 1 and numel > 0 else 1
+    row_len = numel // channels
+    group = max(1, min(group_size, row_len)) if granularity == "Per Group" else max(1, row_len)
+    return channels, row_len, group
+
+def pack_codes(codes, bits):
+    if bits == 8:
+        return codes
+    bitplanes = ((codes.unsqueeze(1) >> torch.arange(bits, dtype=torch.uint8)) & 1).reshape(-1)
+    pad = -bitplanes.numel() % 8
+    if pad:
+        bitplanes = torch.cat([bitplanes, bitplanes.new_zeros(pad)])
+    return (bitplanes.view(-1, 8) << torch.arange(8, dtype=torch.uint8)).sum(dim=1, dtype=torch.uint8)
+
+def unpack_codes(packed, bits, count):
+    if bits == 8:
+        return packed[:count]
+    bitplanes = ((packed.unsqueeze(1) >> torch.arange(8, dtype=torch.uint8, device=packed.device)) & 1).reshape(-1)[:count * bits]
+    return (bitplanes.view(count, bits) << torch.arange(bits, dtype=torch.uint8, device=packed.device)).sum(dim=1, dtype=torch.uint8)
+
+def _fit_codes(rows, min_val, max_val, span, levels):
+    scale = (max_val - min_val) / span
+    constant_rows = scale == 0
+    zero_point = torch.round(-min_val / scale.masked_fill(constant_rows, 1.0))
+    scale = torch.where(constant_rows, min_val.abs().masked_fill(min_val == 0, 1.0), scale)
+    zero_point = torch.where(constant_rows, (min_val < 0).to(torch.float32), zero_point)
+    codes = torch.clamp(torch.round(rows / scale + zero_point), 0, levels)
+    error = ((codes - zero_point) * scale - rows).abs().amax(dim=1, keepdim=True)
+    return codes.to(torch.uint8), scale, zero_point, error
+
+def packed_tensor_spec(shape, dtype, bits, granularity="Per Tensor", group_size=64):
+    shape = list(shape)
+    channels, row_len, group = quantization_layout(shape, granularity, group_size)
+    spec = {"shape": shape, "dtype": SAFETENSORS_DTYPES[dtype], "bits": bits,
+            "channels": channels, "row_len": row_len, "group": group}
+    padded_count = channels * (row_len + (-row_len % group))
+    qweight_len = padded_count if bits == 8 else (padded_count * bits + 7) // 8
+    parts = {".qweight": (torch.uint8, [qweight_len]), ".qscale": (torch.float32, [padded_count // group]),
+             ".qzero": (torch.float32, [padded_count // group])}
+    return spec, parts
+
+def pack_quantized_tensor(tensor, bits, granularity="Per Tensor", group_size=64):
+    spec, _ = packed_tensor_spec(tensor.shape, tensor.dtype, bits, granularity, group_size)
+    channels, row_len, group = spec["channels"], spec["row_len"], spec["group"]
+    values = tensor.detach().to("cpu", torch.float32).reshape(channels, row_len)
+    pad = -row_len % group
+    if pad:
+        values = torch.nn.functional.pad(values.unsqueeze(1), (0, pad), mode="replicate").squeeze(1)
+    rows = values.reshape(-1, group)
+
+    levels = 2**bits - 1
+    min_val = rows.amin(dim=1, keepdim=True)
+    max_val = rows.amax(dim=1, keepdim=True)
+    codes, scale, zero_point, error = _fit_codes(rows, min_val, max_val, levels, levels)
+    if levels > 1:
+        narrow = _fit_codes(rows, min_val, max_val, levels - 1, levels)
+        use_narrow = narrow[3] < error
+        codes = torch.where(use_narrow, narrow[0], codes)
+        scale = torch.where(use_narrow, narrow[1], scale)
+        zero_point = torch.where(use_narrow, narrow[2], zero_point)
+
+    return pack_codes(codes.reshape(-1), bits), scale.reshape(-1), zero_point.reshape(-1), spec
+
+def dequantize_packed_tensor(qweight, qscale, qzero, spec):
+    channels, row_len, group = spec["channels"], spec["row_len"], spec["group"]
+    padded_len = row_len + (-row_len % group)
+    codes = unpack_codes(qweight, spec["bits"], channels * padded_len)
+    values = (codes.to(torch.float32).view(-1, group) - qzero.view(-1, 1)) * qscale.view(-1, 1)
+    values = values.view(channels, padded_len)[:, :row_len]
+    return values.reshape(spec["shape"]).to(TORCH_DTYPES[spec["dtype"]])
+
+def pack_lora(lora, keys, bits, granularity="Per Tensor", group_size=64):
+    packed = {key: value for key, value in lora.items() if key not in keys}
+    specs = {}
+    for key in keys:
+        qweight, qscale, qzero, spec = pack_quantized_tensor(lora[key], bits, granularity, group_size)
+        packed[f"{key}.qweight"] = qweight
+        packed[f"{key}.qscale"] = qscale
+        packed[f"{key}.qzero"] = qzero
+        specs[key] = spec
+    return packed, {"format": PACKED_LORA_FORMAT, "tensors": specs}
+
+def read_packed_spec(metadata):
+    if not metadata or PACKED_LORA_METADATA_KEY not in metadata:
+        return None
+    try:
+        spec = json.loads(metadata[PACKED_LORA_METADATA_KEY])
+    except (TypeError, ValueError):
+        return None
+    return spec if spec.get("format") == PACKED_LORA_FORMAT else None
+
+def unpack_lora(state_dict, packed_spec):
+    if not packed_spec:
+        return state_dict
+    tensors = packed_spec["tensors"]
+    unpacked = {key: value for key, value in state_dict.items()
+                if not (key.endswith(PACKED_PART_SUFFIXES) and key.rsplit(".", 1)[0] in tensors)}
+    for key, spec in tensors.items():
+        unpacked[key] = dequantize_packed_tensor(state_dict[f"{key}.qweight"], state_dict[f"{key}.qscale"],
+                                                 state_dict[f"{key}.qzero"], spec)
+    return unpacked
+
+def load_lora_state_dict(path, keep_packed=False):
+    state_dict = comfy.utils.load_torch_file(path, safe_load=True)
+    packed_spec = read_packed_spec(read_safetensors_header(path)[1]) if is_safetensors_file(path) else None
+    if keep_packed:
+        return state_dict, packed_spec
+    return unpack_lora(state_dict, packed_spec), None
+
+
+class LazyLoraFile:
+    def __init__(self, path):
+        self.path = path
+        self._handle = None
+        self._loaded = None
+        self._packed = {}
+        if is_safetensors_file(path):
+            self._header, self.metadata = read_safetensors_header(path)
+            packed_spec = read_packed_spec(self.metadata)
+            if packed_spec:
+                self._packed = packed_spec["tensors"]
+                for key, spec in self._packed.items():
+                    for suffix in PACKED_PART_SUFFIXES:
+                        self._header.pop(key + suffix, None)
+                    self._header[key] = {"shape": spec["shape"], "dtype": spec["dtype"]}
+        else:
+            self._loaded = comfy.utils.load_torch_file(path, safe_load=True)
+            self._header = {key: {"shape": list(value.shape), "dtype": SAFETENSORS_DTYPES.get(value.dtype, str(value.dtype))}
+                            for key, value in self._loaded.items() if hasattr(value, "shape")}
+            self.metadata = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self._header
+
+    def __iter__(self):
+        return iter(self._header)
+
+    def __len__(self):
+        return len(self._header)
+
+    def __getitem__(self, key):
+        return self.get_tensor(key)
+
+    def keys(self):
+        return self._header.keys()
+
+    def shape(self, key):
+        return tuple(self._header[key]["shape"])
+
+    def dtype(self, key):
+        return self._header[key]["dtype"]
+
+    def get_tensor(self, key):
+        if self._loaded is not None:
+            return self._loaded[key]
+        if self._handle is None:
+            self._handle = safe_open(self.path, framework="pt", device="cpu")
+        if key in self._packed:
+            return dequantize_packed_tensor(*(self._handle.get_tensor(key + suffix) for suffix in PACKED_PART_SUFFIXES),
+                                            self._packed[key])
+        return self._handle.get_tensor(key)
+
+    def load(self, keys=None):
+        return {key: self.get_tensor(key) for key in (self._header if keys is None else keys)}
+
+    def close(self):
+        self._handle = None
+
+
+def _tensor_bytes(tensor):
+    tensor = tensor.detach().to("cpu").contiguous().reshape(-1)
+    return tensor.view(torch.uint8).numpy()
+
+def _create_temp_file(directory):
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0)
+    while True:
+        temp_path = os.path.join(directory, f".{os.urandom(8).hex()}.tmp")
+        try:
+            return os.open(temp_path, flags, 0o666), temp_path
+        except FileExistsError:
+            continue
+
+def write_safetensors_chunks(specs, chunks, path, metadata=None):
+    for name, (dtype, _) in specs.items():
+        if dtype not in SAFETENSORS_DTYPES:
+            raise ValueError(f"Unsupported dtype {dtype} for tensor '{name}'")
+    element_sizes = {dtype: torch.empty((), dtype=dtype).element_size() for dtype, _ in specs.values()}
+    ordered = sorted(specs, key=lambda name: (-element_sizes[specs[name][0]], name))
+    header = {}
+    if metadata:
+        header["__metadata__"] = {str(k): v if isinstance(v, str) else str(v) for k, v in metadata.items()}
+    offset = 0
+    for name in ordered:
+        dtype, shape = specs[name]
+        nbytes = int(np.prod(shape)) * element_sizes[dtype]
+        header[name] = {"dtype": SAFETENSORS_DTYPES[dtype], "shape": list(shape), "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = _create_temp_file(directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(struct.pack("<Q", len(header_bytes)))
+            f.write(header_bytes)
+            data_start = f.tell()
+            pending = set(specs)
+            for chunk in chunks:
+                for name, tensor in chunk.items():
+                    entry = header.get(name)
+                    if entry is None or tensor.dtype != specs[name][0] or list(tensor.shape) != entry["shape"]:
+                        raise ValueError(f"Tensor '{name}' does not match its declared dtype and shape")
+                    f.seek(data_start + entry["data_offsets"][0])
+                    f.write(_tensor_bytes(tensor))
+                    pending.discard(name)
+            if pending:
+                raise ValueError(f"{len(pending)} declared tensors were never written, e.g. '{min(pending)}'")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def save_safetensors_streaming(tensors, path, metadata=None):
+    tensors = {name: value for name, value in tensors.items() if isinstance(value, torch.Tensor)}
+    specs = {name: (tensor.dtype, list(tensor.shape)) for name, tensor in tensors.items()}
+    write_safetensors_chunks(specs, [tensors], path, metadata)
+
+
+_save_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="tksw_lora_save")
+_prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="tksw_lora_prefetch")
+
+def save_lora_file(tensors, path, metadata=None, background=False, label="LoRA"):
+    def _save():
+        try:
+            save_safetensors_streaming(tensors, path, metadata)
+            print(f"{label} saved to: {path}")
+            return True
+        except Exception as e:
+            print(f"Error saving {label} to {path}: {e}")
+            return False
+
+    if not background:
+        return _save()
+    tensors = dict(tensors)
+    metadata = dict(metadata) if metadata else metadata
+    return _save_executor.submit(_save)
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+FILE_HASH_CACHE_SIZE = 4096
+
+_file_hash_cache = collections.OrderedDict()
+_file_hash_lock = threading.Lock()
+
+def _full_file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def file_content_hash(path):
+    memo_key = file_fingerprint(path)
+    with _file_hash_lock:
+        digest = _file_hash_cache.get(memo_key)
+        if digest is not None:
+            _file_hash_cache.move_to_end(memo_key)
+            return digest
+    digest = _full_file_hash(path)
+    with _file_hash_lock:
+        _file_hash_cache[memo_key] = digest
+        while len(_file_hash_cache) > FILE_HASH_CACHE_SIZE:
+            _file_hash_cache.popitem(last=False)
+    return digest
+
+
+def fuse_lora_parts(module_parts):
+    patches = []
+    for module, parts in module_parts.items():
+        shape_groups = {}
+        for down, up, scale in parts:
+            shape_groups.setdefault((tuple(down.shape[1:]), up.shape[0], tuple(up.shape[2:])), []).append((down, up, scale))
+        for patch_index, group in enumerate(shape_groups.values()):
+            if patch_index == len(patches):
+                patches.append({})
+            dtype = group[0][0].dtype
+            patches[patch_index][f"{module}.lora_down.weight"] = torch.cat([down.to(dtype) for down, _, _ in group], dim=0)
+            patches[patch_index][f"{module}.lora_up.weight"] = torch.cat([up.to(dtype) * scale for _, up, scale in group], dim=1)
+    return patches
+
+
+def tensor_dict_nbytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors.values() if isinstance(t, torch.Tensor))
+
+
+class ProcessedLoraCache:
+    def __init__(self, max_ram_bytes=PROCESSED_LORA_RAM_BYTES, disk_dir=PROCESSED_LORA_DISK_DIR,
+                 max_disk_bytes=PROCESSED_LORA_DISK_BYTES):
+        self.max_ram_bytes = max_ram_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = collections.OrderedDict()
+        self._ram_bytes = 0
+        self._lock = threading.Lock()
+        self.ram_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, node_name, paths, params):
+        return (node_name, tuple(file_fingerprint(path) for path in paths), params)
+
+    def _disk_path(self, key):
+        node_name, fingerprints, params = key
+        sha = hashlib.sha256(node_name.encode("utf-8"))
+        for path, _, _ in fingerprints:
+            sha.update(file_content_hash(path).encode("ascii"))
+        sha.update(repr(params).encode("utf-8"))
+        return os.path.join(self.disk_dir, f"{node_name}_{sha.hexdigest()[:32]}.safetensors")
+
+    def get(self, key, use_disk=False):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.ram_hits += 1
+                print(f"[LoRA Cache] RAM hit for {key[0]} ({self.format_stats()})")
+                return dict(entry[0]), entry[1]
+
+        if use_disk:
+            try:
+                disk_path = self._disk_path(key)
+                if os.path.exists(disk_path):
+                    tensors = load_file(disk_path, device="cpu")
+                    with safe_open(disk_path, framework="pt", device="cpu") as f:
+                        info = json.loads((f.metadata() or {}).get("info", "null"))
+                    os.utime(disk_path)
+                    with self._lock:
+                        self.disk_hits += 1
+                    self._store_ram(key, tensors, info)
+                    print(f"[LoRA Cache] Disk hit for {key[0]} ({self.format_stats()})")
+                    return dict(tensors), info
+            except Exception as e:
+                print(f"[LoRA Cache] Error reading disk cache entry: {e}")
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, tensors, info=None, use_disk=False):
+        tensors = dict(tensors)
+        self._store_ram(key, tensors, info)
+        if use_disk and all(isinstance(v, torch.Tensor) for v in tensors.values()):
+            try:
+                self._store_disk(key, tensors, info)
+            except Exception as e:
+                print(f"[LoRA Cache] Error writing disk cache entry: {e}")
+
+    def _store_ram(self, key, tensors, info):
+        nbytes = tensor_dict_nbytes(tensors)
+        if nbytes > self.max_ram_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._ram_bytes -= previous[2]
+            self._entries[key] = (tensors, info, nbytes)
+            self._ram_bytes += nbytes
+            while self._ram_bytes > self.max_ram_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._ram_bytes -= evicted[2]
+                self.evictions += 1
+
+    def _store_disk(self, key, tensors, info):
+        save_safetensors_streaming(tensors, self._disk_path(key), metadata={"info": json.dumps(info)})
+        self._trim_disk()
+
+    def _trim_disk(self):
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".safetensors"):
+                path = os.path.join(self.disk_dir, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._ram_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "ram_bytes": self._ram_bytes,
+                "ram_hits": self.ram_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def format_stats(self):
+        return (f"entries={len(self._entries)}, ram={self._ram_bytes / 1024 ** 2:.1f}MiB, "
+                f"hits={self.ram_hits}+{self.disk_hits}, misses={self.misses}, evictions={self.evictions}")
+
+
+processed_lora_cache = ProcessedLoraCache()
+
+
+class LoraTensorCache:
+    def __init__(self, max_bytes=PROCESSED_LORA_RAM_BYTES, tier="CPU"):
+        self.max_bytes = max_bytes
+        self.tier = tier
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetches = 0
+        self.prefetch_waits = 0
+
+    def configure(self, max_bytes, tier="CPU"):
+        if tier == "Pinned CPU" and not torch.cuda.is_available():
+            print("[LoRA Tensor Cache] Pinned memory requires CUDA. Using the CPU tier.")
+            tier = "CPU"
+        if tier != self.tier:
+            self.clear()
+            self.tier = tier
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._trim()
+
+    def _to_tier(self, state_dict):
+        if self.tier == "Pinned CPU":
+            return {k: v.pin_memory() if isinstance(v, torch.Tensor) else v for k, v in state_dict.items()}
+        if self.tier == "GPU":
+            device = comfy.model_management.get_torch_device()
+            return {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in state_dict.items()}
+        return state_dict
+
+    def _trim(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self._bytes -= nbytes
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, lora_data):
+        state_dict, spec = lora_data
+        nbytes = tensor_dict_nbytes(state_dict)
+        if nbytes > self.max_bytes:
+            return lora_data
+        lora_data = (self._to_tier(state_dict), spec)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (lora_data, nbytes)
+            self._bytes += nbytes
+            self._trim()
+        return lora_data
+
+    def load(self, path, loader):
+        with self._lock:
+            future = self._pending.get(path)
+        if future is not None:
+            try:
+                lora_data = future.result()
+                with self._lock:
+                    self.prefetch_waits += 1
+                return lora_data
+            except Exception as e:
+                print(f"[LoRA Tensor Cache] Prefetch of '{path}' failed: {e}")
+        key = file_content_hash(path)
+        lora_data = self.get(key)
+        if lora_data is None:
+            lora_data = self.put(key, loader(path))
+        return lora_data
+
+    def entry_nbytes(self, path):
+        key = file_content_hash(path)
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[1] if entry is not None else 0
+
+    def prefetch(self, path, loader, keep_path=None):
+        needed = os.path.getsize(path) + (self.entry_nbytes(keep_path) if keep_path else 0)
+        if needed > self.max_bytes:
+            print(f"[LoRA Tensor Cache] Skipping prefetch of '{path}': the cache cannot hold it next to the current LoRA.")
+            return None
+        with self._lock:
+            future = self._pending.get(path)
+            if future is None:
+                future = self._pending[path] = _prefetch_executor.submit(self._prefetch, path, loader)
+        return future
+
+    def _prefetch(self, path, loader):
+        try:
+            key = file_content_hash(path)
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                return entry[0]
+            lora_data = self.put(key, loader(path))
+            with self._lock:
+                self.prefetches += 1
+            return lora_data
+        finally:
+            with self._lock:
+                self._pending.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "tier": self.tier,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "prefetches": self.prefetches,
+                "prefetch_waits": self.prefetch_waits,
+            }
+
+    def format_stats(self):
+        return (f"entries={len(self._entries)}, {self.tier}={self._bytes / 1024 ** 3:.2f}/{self.max_bytes / 1024 ** 3:.1f}GiB, "
+                f"hits={self.hits}, misses={self.misses}, evictions={self.evictions}, "
+                f"prefetched={self.prefetches}, prefetch_waits={self.prefetch_waits}")
@@ -1,14 +1,15 @@
-from folder_paths import get_filename_list
-from nodes import LoraLoader
-import random
-import torch
+from folder_paths import get_filename_list, get_full_path
+import comfy.sd
+import csv
+import io
+import json
+import numpy as np
+from .lora_utils import processed_lora_cache, load_lora_state_dict, fuse_lora_parts
+from .rng_utils import node_rng
 
 LORA_COUNT = 8
 
 class LoraWeightRandomizer:
-    def __init__(self):
-        self.loras = [LoraLoader() for _ in range(LORA_COUNT)]
-
     @classmethod
     def INPUT_TYPES(cls):
         args = {
@@ -22,9 +23,90 @@ class LoraWeightRandomizer:
         arg_lora_name = ([""] + get_filename_list("loras"),)
         for i in range(LORA_COUNT):
             args["{}:lora".format(i)] = arg_lora_name
-        return {"required": args}
+        return {
+            "required": args,
+            "optional": {
+                "sweep_count": ("INT", {"default": 1, "min": 1, "max": 64}),
+                "sweep_format": (["JSON", "CSV"], {"default": "JSON"}),
+            },
+            "hidden": {"unique_id": "UNIQUE_ID"},
+        }
 
-    def apply(self, model, clip, total_strength, max_single_strength, randomize_total_strength, seed, **kwargs):
+    def _allocate_strengths(self, rng, num_selected, total_strength, max_single_strength, randomize_total_strength, variants=1):
+        uniforms = rng.random((variants, 2 * num_selected + 1))
+        totals = np.full(variants, float(total_strength))
+        if randomize_total_strength:
+            totals = np.round(uniforms[:, 0] * totals, 2)
+
+        allocation_order = np.argsort(uniforms[:, 1:num_selected + 1], axis=1)
+        draws = uniforms[:, num_selected + 1:]
+        rows = np.arange(variants)
+        strengths = np.zeros((variants, num_selected))
+        remaining_strength = totals.copy()
+        for step in range(num_selected - 1):
+            max_allowed = np.minimum(remaining_strength, max_single_strength)
+            strength = np.round(draws[:, step] * max_allowed, 2)
+            strengths[rows, allocation_order[:, step]] = strength
+            remaining_strength -= strength
+        strengths[rows, allocation_order[:, -1]] = np.round(np.minimum(remaining_strength, max_single_strength), 2)
+
+        diff = totals - strengths.sum(axis=1)
+        under_max = strengths < max_single_strength
+        num_under_max = under_max.sum(axis=1)
+        increment = np.where((diff > 0) & (num_under_max > 0), diff / np.maximum(num_under_max, 1), 0.0)
+        add = np.minimum(increment[:, None], max_single_strength - strengths)
+        strengths = np.where(under_max, np.round(strengths + add, 2), strengths)
+        return totals, strengths
+
+    def _load_lora(self, lora_name):
+        lora_path = get_full_path("loras", lora_name)
+        cache_key = processed_lora_cache.make_key("LoraWeightRandomizer", [lora_path], ("source",))
+        cached = processed_lora_cache.get(cache_key)
+        if cached is not None:
+            return cached[0]
+        lora, _ = load_lora_state_dict(lora_path)
+        processed_lora_cache.put(cache_key, lora)
+        return lora
+
+    def _combine_loras(self, weighted_loras):
+        module_parts = {}
+        residual_loras = []
+        for lora, strength in weighted_loras:
+            fused_modules = set()
+            for down_key, down in lora.items():
+                if not down_key.endswith(".lora_down.weight"):
+                    continue
+                module = down_key[:-len(".lora_down.weight")]
+                up = lora.get(f"{module}.lora_up.weight")
+                if up is None or up.shape[1] != down.shape[0] or f"{module}.lora_mid.weight" in lora or f"{module}.dora_scale" in lora:
+                    continue
+                alpha = lora.get(f"{module}.alpha")
+                scale = alpha.item() / down.shape[0] if alpha is not None else 1.0
+                module_parts.setdefault(module, []).append((down, up, strength * scale))
+                fused_modules.add(module)
+
+            fused_keys = {f"{module}.{suffix}" for module in fused_modules for suffix in ("lora_down.weight", "lora_up.weight", "alpha")}
+            residual = {k: v for k, v in lora.items() if k not in fused_keys}
+            if residual:
+                residual_loras.append((residual, strength))
+
+        return fuse_lora_parts(module_parts), residual_loras
+
+    def _format_sweep_table(self, lora_names, totals, allocations, sweep_format):
+        if sweep_format == "CSV":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(["variant", "total_strength"] + lora_names)
+            for variant, (total, strengths) in enumerate(zip(totals, allocations)):
+                writer.writerow([variant, f"{total:.2f}"] + [f"{strength:.2f}" for strength in strengths])
+            return buffer.getvalue().rstrip("\n")
+        rows = [{"variant": variant, "total_strength": round(float(total), 2),
+                 "weights": [{"lora": name, "strength": round(float(strength), 2)} for name, strength in zip(lora_names, strengths)]}
+                for variant, (total, strengths) in enumerate(zip(totals, allocations))]
+        return json.dumps(rows, indent=1)
+
+    def apply(self, model, clip, total_strength, max_single_strength, randomize_total_strength, seed,
+              sweep_count=1, sweep_format="JSON", unique_id=None, **kwargs):
         selected_loras = []
         for i in range(LORA_COUNT):
             lora_name = kwargs["{}:lora".format(i)]
@@ -32,61 +114,44 @@ class LoraWeightRandomizer:
                 selected_loras.append((lora_name, i))
 
         if not selected_loras:
-            return (model, clip, "") 
+            return ([model], [clip], "", "")
 
-        torch.manual_seed(seed)
-        random.seed(seed)
-
-        if randomize_total_strength:
-            total_strength = round(random.uniform(0, total_strength), 2)
-
-        num_selected = len(selected_loras)
-        strengths = [0.00] * num_selected
-        remaining_strength = total_strength
-
-        allocation_order = list(range(num_selected))
-        random.shuffle(allocation_order)
-
-        for i in allocation_order[:-1]:
-            max_allowed = min(remaining_strength, max_single_strength)
-            strength = round(random.uniform(0, max_allowed), 2)
-            strengths[i] = strength
-            remaining_strength -= strength
-
-        strengths[allocation_order[-1]] = round(min(remaining_strength, max_single_strength), 2)
-
-        allocated_strength_total = sum(strengths)
-        if allocated_strength_total < total_strength:
-            diff = total_strength - allocated_strength_total
-            num_under_max = sum(1 for s in strengths if s < max_single_strength)
-            if num_under_max > 0:
-                increment = diff / num_under_max
-                for i in range(len(strengths)):
-                    if strengths[i] < max_single_strength:
-                        add = min(increment, max_single_strength - strengths[i])
-                        strengths[i] = round(strengths[i] + add, 2)
-
-        reordered_strengths = [0.00] * num_selected
-        for i, original_index in enumerate(allocation_order):
-            reordered_strengths[original_index] = strengths[i]
-        strengths = reordered_strengths
+        lora_names = [lora_name for lora_name, _ in selected_loras]
+        totals, allocations = self._allocate_strengths(node_rng(seed, "LoraWeightRandomizer", node_id=unique_id), len(selected_loras),
+                                                       total_strength, max_single_strength, randomize_total_strength,
+                                                       variants=max(1, sweep_count))
+        loaded_loras = {lora_name: self._load_lora(lora_name)
+                        for slot, lora_name in enumerate(lora_names) if allocations[:, slot].any()}
 
         output_text = f"LoraWeightRandomizer Settings:\n"
-        output_text += f"  Total Strength: {total_strength:.2f}\n"
+        output_text += f"  Total Strength: {float(totals[0]):.2f}\n"
         output_text += f"  Max Single Strength: {max_single_strength:.2f}\n"
         output_text += f"  Randomize Total Strength: {randomize_total_strength}\n"
         output_text += f"  Seed: {seed}\n"
+        if len(totals) > 1:
+            output_text += f"  Sweep Variants: {len(totals)}\n"
         output_text += "LoRA Weights:\n"
-
-        for (lora_name, index), strength in zip(selected_loras, strengths):
+        for lora_name, strength in zip(lora_names, allocations[0]):
             output_text += f"  - {lora_name}: {strength:.2f}\n"
-            (model, clip) = self.loras[index].load_lora(model, clip, lora_name, strength, strength)
-
-
-        return (model, clip, output_text)
-
 
-    RETURN_TYPES = ("MODEL", "CLIP", "STRING")
-    RETURN_NAMES = ("MODEL", "CLIP", "settings")
+        models, clips = [], []
+        for strengths in allocations:
+            weighted_loras = [(loaded_loras[lora_name], float(strength))
+                              for lora_name, strength in zip(lora_names, strengths) if strength != 0]
+            combined_loras, residual_loras = self._combine_loras(weighted_loras)
+            variant_model, variant_clip = model, clip
+            for combined_lora in combined_loras:
+                (variant_model, variant_clip) = comfy.sd.load_lora_for_models(variant_model, variant_clip, combined_lora, 1.0, 1.0)
+            for residual, strength in residual_loras:
+                (variant_model, variant_clip) = comfy.sd.load_lora_for_models(variant_model, variant_clip, residual, strength, strength)
+            models.append(variant_model)
+            clips.append(variant_clip)
+
+        return (models, clips, output_text, self._format_sweep_table(lora_names, totals, allocations, sweep_format))
+
+
+    RETURN_TYPES = ("MODEL", "CLIP", "STRING", "STRING")
+    RETURN_NAMES = ("MODEL", "CLIP", "settings", "sweep_table")
+    OUTPUT_IS_LIST = (True, True, False, False)
     FUNCTION = "apply"
     CATEGORY = "tksw_node"
\ No newline at end of file
@@ -1,11 +1,58 @@
 import torch
-import comfy.utils
+import torch.nn.functional as F
+import comfy.model_management
 import folder_paths
 import comfy.sd
-from safetensors.torch import safe_open, save_file
 import json
 import os
 import numpy as np
+import math
+import concurrent.futures
+from .lora_utils import (processed_lora_cache, save_lora_file, load_lora_state_dict, pack_lora, CACHE_MODES,
+                         PACKED_LORA_METADATA_KEY, PACKED_LORA_FORMAT, TORCH_DTYPES, LazyLoraFile, packed_tensor_spec,
+                         write_safetensors_chunks, is_safetensors_file, read_safetensors_header)
+
+QUANTIZATION_GRANULARITIES = ["Per Tensor", "Per Channel", "Per Group"]
+QUANTIZATION_BATCH_ELEMENTS = 1 << 22
+BATCH_MANIFEST_NAME = "quantization_manifest.json"
+
+def _fake_quantize_rows_(rows, bits, zero_constant=False):
+    levels = 2**bits - 1
+    min_val = rows.amin(dim=1, keepdim=True)
+    max_val = rows.amax(dim=1, keepdim=True)
+    scale = (max_val - min_val).div_(levels)
+    constant_rows = scale == 0
+    scale.masked_fill_(constant_rows, 1.0)
+    zero_point = torch.round(min_val.neg_().div_(scale))
+
+    rows.div_(scale).add_(zero_point).round_().clamp_(0, levels).sub_(zero_point).mul_(scale)
+    if zero_constant:
+        rows.masked_fill_(constant_rows, 0.0)
+    else:
+        rows.masked_fill_(constant_rows, 0.0).add_(max_val.masked_fill_(~constant_rows, 0.0))
+    return rows
+
+def fake_quantize_batch_(batch, bit_levels, granularity="Per Tensor", group_size=64):
+    batch_size = batch.shape[0]
+    if granularity == "Per Tensor" or batch.dim() < 3:
+        rows = batch.view(batch_size, -1)
+    else:
+        rows = batch.view(batch_size * batch.shape[1], -1)
+
+    if granularity != "Per Group":
+        for bits in bit_levels:
+            _fake_quantize_rows_(rows, bits, zero_constant=granularity == "Per Tensor")
+        return batch
+
+    row_len = rows.shape[1]
+    group_size = max(1, min(group_size, row_len))
+    pad = -row_len % group_size
+    grouped = F.pad(rows.unsqueeze(1), (0, pad), mode="replicate").squeeze(1) if pad else rows
+    for bits in bit_levels:
+        _fake_quantize_rows_(grouped.view(-1, group_size), bits)
+    if pad:
+        rows.copy_(grouped[:, :row_len])
+    return batch
 
 class QuantizedLoraLoader:
     @classmethod
@@ -27,6 +74,13 @@ class QuantizedLoraLoader:
                 "clip": ("CLIP",),
                 "save_quantized_lora": ("BOOLEAN", {"default": False}),
                 "save_name": ("STRING", {"default": "quantized_lora"}),
+                "cache_mode": (CACHE_MODES, {"default": "RAM"}),
+                "background_save": ("BOOLEAN", {"default": True}),
+                "quantization_granularity": (QUANTIZATION_GRANULARITIES, {"default": "Per Tensor"}),
+                "group_size": ("INT", {"default": 64, "min": 1, "max": 4096, "step": 1}),
+                "quantization_device": (["CPU", "GPU"], {"default": "CPU"}),
+                "storage_format": (["Dequantized", "Packed"], {"default": "Dequantized"}),
+                "error_report": ("BOOLEAN", {"default": False}),
             }
         }
 
@@ -41,30 +95,125 @@ class QuantizedLoraLoader:
     FUNCTION = "load_and_quantize_lora"
     CATEGORY = "tksw_node"
 
-    def _quantize_tensor(self, tensor, bits):
-        original_dtype = tensor.dtype
-        min_val = tensor.min()
-        max_val = tensor.max()
+    def _quantize_tensor(self, tensor, bits, granularity="Per Tensor", group_size=64):
+        batch = tensor.to(torch.float32, copy=True).unsqueeze(0)
+        return fake_quantize_batch_(batch, [bits], granularity, group_size)[0].to(tensor.dtype)
+
+    def _original_bits(self, dtypes):
+        original_dtype = None
+        for dtype in dtypes:
+            if original_dtype is None:
+                original_dtype = dtype
+            elif original_dtype == torch.float16 and dtype == torch.bfloat16:
+                original_dtype = torch.bfloat16
+        return 32 if original_dtype == torch.float32 else 16
+
+    def _bit_levels(self, original_bits, quantization_bits, quantization_iterations, stepwise_quantization, quantization_step_size):
+        if not stepwise_quantization or quantization_bits >= original_bits:
+            return [quantization_bits] * quantization_iterations
+        bit_levels = []
+        current_bits = original_bits
+        while current_bits > quantization_bits:
+            current_bits = max(current_bits - quantization_step_size, quantization_bits)
+            bit_levels.append(current_bits)
+        return bit_levels
+
+    def _quantize_lora_tensors(self, lora, keys, bit_levels, granularity, group_size, blend_factor=None, device="cpu"):
+        shape_groups = {}
+        for key in keys:
+            tensor = lora[key]
+            shape_groups.setdefault((tuple(tensor.shape), tensor.dtype), []).append(key)
 
-        if max_val - min_val == 0:
-            return torch.zeros_like(tensor, dtype=original_dtype)
+        quantized = {}
+        for (shape, dtype), group_keys in shape_groups.items():
+            numel = max(1, int(np.prod(shape)))
+            chunk_len = max(1, QUANTIZATION_BATCH_ELEMENTS // numel)
+            for start in range(0, len(group_keys), chunk_len):
+                chunk_keys = group_keys[start:start + chunk_len]
+                batch = torch.empty((len(chunk_keys),) + shape, dtype=torch.float32, device=device)
+                for i, key in enumerate(chunk_keys):
+                    batch[i].copy_(lora[key])
+                fake_quantize_batch_(batch, bit_levels, granularity, group_size)
+                if blend_factor is not None:
+                    batch.mul_(1 - blend_factor)
+                    for i, key in enumerate(chunk_keys):
+                        batch[i].add_(lora[key].to(device), alpha=blend_factor)
+                result = batch.to("cpu", dtype)
+                for i, key in enumerate(chunk_keys):
+                    quantized[key] = result[i]
+        return quantized
 
-        scale = (max_val - min_val) / (2**bits - 1)
-        zero_point = torch.round(-min_val / scale)
+    def _quantization_error_report(self, original, quantized, device="cpu"):
+        return self._summarize_quantization_errors(*self._module_quantization_errors(original, quantized, device))
 
-        quantized_tensor = torch.clamp(torch.round(tensor / scale + zero_point), 0, 2**bits - 1)
-        dequantized_tensor = (quantized_tensor - zero_point) * scale
+    def _module_quantization_errors(self, original, quantized, device="cpu"):
+        shape_groups = {}
+        for up_key in quantized:
+            if not up_key.endswith(".lora_up.weight"):
+                continue
+            module = up_key[:-len(".lora_up.weight")]
+            down_key = f"{module}.lora_down.weight"
+            if down_key not in quantized or up_key not in original or down_key not in original:
+                continue
+            up_shape, down_shape = tuple(original[up_key].shape), tuple(original[down_key].shape)
+            if int(np.prod(up_shape)) // up_shape[0] != down_shape[0]:
+                continue
+            shape_groups.setdefault((up_shape, down_shape), []).append(module)
 
-        return dequantized_tensor.to(original_dtype)
+        modules = {}
+        total_signal = 0.0
+        total_error = 0.0
+        for (up_shape, down_shape), group_modules in shape_groups.items():
+            out_dim, rank = up_shape[0], down_shape[0]
+            in_dim = int(np.prod(down_shape)) // rank
+            chunk_len = max(1, QUANTIZATION_BATCH_ELEMENTS // max(1, out_dim * in_dim))
+            for start in range(0, len(group_modules), chunk_len):
+                chunk = group_modules[start:start + chunk_len]
 
-    def _save_processed_lora(self, lora, save_name, quantization_bits, quantization_iterations, stepwise_quantization, quantization_step_size, blend_mode, blend_factor):
+                def stacked(lora, suffix, rows):
+                    return torch.stack([lora[f"{m}{suffix}"].to(device, torch.float32).reshape(rows, -1) for m in chunk])
+
+                delta = torch.bmm(stacked(original, ".lora_up.weight", out_dim), stacked(original, ".lora_down.weight", rank))
+                error = torch.bmm(stacked(quantized, ".lora_up.weight", out_dim), stacked(quantized, ".lora_down.weight", rank))
+                error.sub_(delta)
+                signal_energy = delta.pow_(2).sum(dim=(1, 2)).double().cpu()
+                max_abs = error.abs().amax(dim=(1, 2)).cpu()
+                error_energy = error.pow_(2).sum(dim=(1, 2)).double().cpu()
+                numel = out_dim * in_dim
+                for i, module in enumerate(chunk):
+                    signal, err = signal_energy[i].item(), error_energy[i].item()
+                    total_signal += signal
+                    total_error += err
+                    modules[module] = {
+                        "mse": err / numel,
+                        "snr_db": round(10 * math.log10(signal / err), 3) if err > 0 and signal > 0 else None,
+                        "max_abs": max_abs[i].item(),
+                    }
+        return modules, total_signal, total_error
+
+    def _summarize_quantization_errors(self, modules, total_signal, total_error):
+        snrs = sorted(m["snr_db"] for m in modules.values() if m["snr_db"] is not None)
+        worst_module = min((name for name in modules if modules[name]["snr_db"] is not None),
+                           key=lambda name: modules[name]["snr_db"], default=None)
+        summary = {
+            "modules": len(modules),
+            "overall_snr_db": round(10 * math.log10(total_signal / total_error), 3) if total_error > 0 and total_signal > 0 else None,
+            "min_snr_db": snrs[0] if snrs else None,
+            "median_snr_db": snrs[len(snrs) // 2] if snrs else None,
+            "mean_mse": sum(m["mse"] for m in modules.values()) / len(modules) if modules else 0.0,
+            "max_abs": max((m["max_abs"] for m in modules.values()), default=0.0),
+            "worst_module": worst_module,
+        }
+        ordered = sorted(modules.items(), key=lambda item: float("inf") if item[1]["snr_db"] is None else item[1]["snr_db"])
+        return {"summary": summary, "modules": dict(ordered)}
+
+    def _processed_lora_target(self, save_name, metadata, quantization_bits, quantization_iterations, stepwise_quantization,
+                               quantization_step_size, blend_mode, blend_factor, output_dir=None):
         if not save_name.endswith(".safetensors"):
             save_name += ".safetensors"
         base, ext = os.path.splitext(save_name)
         save_name = f"{base}_q{quantization_bits}_i{quantization_iterations}_s{stepwise_quantization}_ss{quantization_step_size}_b{blend_mode}_bf{blend_factor}{ext}"
-        lora_path = os.path.join(folder_paths.get_folder_paths("loras")[0], save_name)
-
-        metadata = lora.pop("metadata", {}) if isinstance(lora, dict) else {}
+        lora_path = os.path.join(output_dir or folder_paths.get_folder_paths("loras")[0], save_name)
 
         if isinstance(metadata, dict):
             metadata["quantization_bits"] = str(quantization_bits)
@@ -86,85 +235,174 @@ class QuantizedLoraLoader:
                 "blend_mode": str(blend_mode), 
                 "blend_factor": str(blend_factor) 
             }
+        return lora_path, metadata
 
-        try:
-            save_file(lora, lora_path, metadata=metadata)
-            print(f"Quantized LoRA saved to: {lora_path}")
-        except Exception as e:
-            print(f"Error saving quantized LoRA: {e}")
+    def _save_processed_lora(self, lora, save_name, quantization_bits, quantization_iterations, stepwise_quantization, quantization_step_size, blend_mode, blend_factor, background_save=False,
+                             quantization_granularity="Per Tensor", group_size=64, storage_format="Dequantized",
+                             output_dir=None):
+        metadata = lora.pop("metadata", {}) if isinstance(lora, dict) else {}
+        lora_path, metadata = self._processed_lora_target(save_name, metadata, quantization_bits, quantization_iterations,
+                                                          stepwise_quantization, quantization_step_size, blend_mode,
+                                                          blend_factor, output_dir)
 
-        if metadata:
-            lora["metadata"] = metadata
+        tensors = lora
+        file_metadata = metadata
+        if storage_format == "Packed":
+            if quantization_bits > 8 or blend_mode:
+                print("Packed storage needs quantization_bits <= 8 and blend_mode off. Saving dequantized tensors instead.")
+            else:
+                pack_keys = [key for key in lora if "lora_down" in key or "lora_up" in key]
+                tensors, packed_spec = pack_lora(lora, pack_keys, quantization_bits, quantization_granularity, group_size)
+                file_metadata = dict(metadata, **{PACKED_LORA_METADATA_KEY: json.dumps(packed_spec)})
 
-    def load_and_quantize_lora(self, lora_name, quantization_bits, strength_model, strength_clip,
-                              model=None, clip=None, save_quantized_lora=False, save_name="quantized_lora",
-                              quantization_iterations=1, stepwise_quantization=False, quantization_step_size=1,
-                              blend_mode=False, blend_factor=0.5): 
+        saved = save_lora_file(tensors, lora_path, metadata=file_metadata, background=background_save, label="Quantized LoRA")
 
-        lora_path = folder_paths.get_full_path_or_raise("loras", lora_name)
+        if metadata:
+            lora["metadata"] = metadata
+        return lora_path, saved
 
+    def _build_quantized_lora(self, lora_path, quantization_bits, quantization_iterations, stepwise_quantization,
+                              quantization_step_size, blend_mode, blend_factor, quantization_granularity="Per Tensor",
+                              group_size=64, quantization_device="CPU", error_report=False):
         try:
-            with safe_open(lora_path, framework="pt", device="cpu") as f:
-                lora_metadata = f.metadata()
-            lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
+            lora_metadata = read_safetensors_header(lora_path)[1] if is_safetensors_file(lora_path) else None
+            lora, _ = load_lora_state_dict(lora_path)
 
         except Exception as e:
             print(f"Error loading LoRA: {e}")
-            return (model, clip, None, None)
-
-        original_dtype = None
-        for key, tensor in lora.items():
-            if "lora_down" in key or "lora_up" in key:
-                if original_dtype is None:
-                    original_dtype = tensor.dtype
-                elif original_dtype == torch.float16 and tensor.dtype == torch.bfloat16:
-                    original_dtype = torch.bfloat16
-
-        original_bits = 32 if original_dtype == torch.float32 else 16
-        quantized_lora = {}
-        original_lora = lora.copy() 
+            return None
 
+        original_bits = self._original_bits(tensor.dtype for key, tensor in lora.items()
+                                            if "lora_down" in key or "lora_up" in key)
 
         if quantization_bits >= original_bits:
             stepwise_quantization = False
+        bit_levels = self._bit_levels(original_bits, quantization_bits, quantization_iterations,
+                                      stepwise_quantization, quantization_step_size)
 
-        if stepwise_quantization:
-             for key, tensor in lora.items():
-                if key == "metadata":
-                    quantized_lora[key] = tensor
-                elif "lora_down" in key or "lora_up" in key:
-                    temp_tensor = tensor
-                    current_bits = original_bits
-                    for _ in range(quantization_iterations):
-                        while current_bits > quantization_bits:
-                            current_bits = max(current_bits - quantization_step_size, quantization_bits)
-                            temp_tensor = self._quantize_tensor(temp_tensor, current_bits)
-                    quantized_lora[key] = temp_tensor
-                else:
-                    quantized_lora[key] = tensor
+        if quantization_device == "GPU":
+            device = comfy.model_management.get_torch_device()
         else:
-            for key, tensor in lora.items():
-                if key == "metadata":
-                    quantized_lora[key] = tensor
-                elif "lora_down" in key or "lora_up" in key:
-                    temp_tensor = tensor
-                    for _ in range(quantization_iterations):
-                        temp_tensor = self._quantize_tensor(temp_tensor, quantization_bits)
-                    quantized_lora[key] = temp_tensor
-                else:
-                    quantized_lora[key] = tensor
-
-        if blend_mode:
-            blended_lora = {}
-            for key in quantized_lora.keys():
-                if key == "metadata":
-                    blended_lora[key] = quantized_lora[key]
-                elif "lora_down" in key or "lora_up" in key:
-                    blended_lora[key] = (1 - blend_factor) * quantized_lora[key] + blend_factor * original_lora[key]
+            device = torch.device("cpu")
+
+        quantize_keys = [key for key in lora if key != "metadata" and ("lora_down" in key or "lora_up" in key)]
+        quantized_lora = dict(lora)
+        quantized_lora.update(self._quantize_lora_tensors(lora, quantize_keys, bit_levels, quantization_granularity,
+                                                          group_size, blend_factor if blend_mode else None, device))
+
+        info = {"metadata": lora_metadata, "stepwise_quantization": stepwise_quantization}
+        if error_report:
+            info["quantization_report"] = self._quantization_error_report(lora, quantized_lora, device)
+        return quantized_lora, info
+
+    def _module_chunks(self, lora):
+        modules = {}
+        for key in lora:
+            module = key
+            for suffix in (".lora_up.weight", ".lora_down.weight"):
+                if key.endswith(suffix):
+                    module = key[:-len(suffix)]
+            modules.setdefault(module, []).append(key)
+
+        chunk, chunk_elements = [], 0
+        for keys in modules.values():
+            elements = sum(int(np.prod(lora.shape(key))) for key in keys)
+            if chunk and chunk_elements + elements > QUANTIZATION_BATCH_ELEMENTS:
+                yield chunk
+                chunk, chunk_elements = [], 0
+            chunk.extend(keys)
+            chunk_elements += elements
+        if chunk:
+            yield chunk
+
+    def _quantize_file(self, source_path, save_name, output_dir, quantization_bits, quantization_iterations,
+                       stepwise_quantization, quantization_step_size, blend_mode, blend_factor,
+                       quantization_granularity, group_size, storage_format, error_report):
+        with LazyLoraFile(source_path) as lora:
+            quantize_keys = {key for key in lora if "lora_down" in key or "lora_up" in key}
+            original_bits = self._original_bits(TORCH_DTYPES[lora.dtype(key)] for key in lora if key in quantize_keys)
+            if quantization_bits >= original_bits:
+                stepwise_quantization = False
+            bit_levels = self._bit_levels(original_bits, quantization_bits, quantization_iterations,
+                                          stepwise_quantization, quantization_step_size)
+
+            packed = storage_format == "Packed" and quantization_bits <= 8 and not blend_mode
+            if storage_format == "Packed" and not packed:
+                print("Packed storage needs quantization_bits <= 8 and blend_mode off. Saving dequantized tensors instead.")
+            output_path, metadata = self._processed_lora_target(save_name, {}, quantization_bits, quantization_iterations,
+                                                                stepwise_quantization, quantization_step_size, blend_mode,
+                                                                blend_factor, output_dir)
+            specs = {}
+            packed_specs = {}
+            for key in lora:
+                dtype = TORCH_DTYPES[lora.dtype(key)]
+                if packed and key in quantize_keys:
+                    packed_specs[key], parts = packed_tensor_spec(lora.shape(key), dtype, quantization_bits,
+                                                                  quantization_granularity, group_size)
+                    specs.update({key + suffix: part for suffix, part in parts.items()})
                 else:
-                    blended_lora[key] = quantized_lora[key]
-            quantized_lora = blended_lora
+                    specs[key] = (dtype, list(lora.shape(key)))
+            if packed:
+                packed_spec = {"format": PACKED_LORA_FORMAT, "tensors": packed_specs}
+                metadata = dict(metadata, **{PACKED_LORA_METADATA_KEY: json.dumps(packed_spec)})
+
+            errors = [{}, 0.0, 0.0]
 
+            def quantized_chunks():
+                for chunk_keys in self._module_chunks(lora):
+                    original = {key: lora.get_tensor(key) for key in chunk_keys}
+                    chunk_quantize_keys = [key for key in chunk_keys if key in quantize_keys]
+                    quantized = self._quantize_lora_tensors(original, chunk_quantize_keys, bit_levels, quantization_granularity,
+                                                            group_size, blend_factor if blend_mode else None)
+                    if error_report:
+                        modules, signal, error = self._module_quantization_errors(original, quantized)
+                        errors[0].update(modules)
+                        errors[1] += signal
+                        errors[2] += error
+                    if packed:
+                        quantized, _ = pack_lora(quantized, chunk_quantize_keys, quantization_bits,
+                                                 quantization_granularity, group_size)
+                    output = {key: value for key, value in original.items() if key not in quantize_keys}
+                    output.update(quantized)
+                    yield output
+
+            write_safetensors_chunks(specs, quantized_chunks(), output_path, metadata)
+        print(f"Quantized LoRA saved to: {output_path}")
+        report = self._summarize_quantization_errors(*errors)["summary"] if error_report else None
+        return {"output": output_path, "saved": True, "report": report}
+
+    def load_and_quantize_lora(self, lora_name, quantization_bits, strength_model, strength_clip,
+                              model=None, clip=None, save_quantized_lora=False, save_name="quantized_lora",
+                              quantization_iterations=1, stepwise_quantization=False, quantization_step_size=1,
+                              blend_mode=False, blend_factor=0.5, cache_mode="RAM", background_save=True,
+                              quantization_granularity="Per Tensor", group_size=64, quantization_device="CPU",
+                              storage_format="Dequantized", error_report=False): 
+
+        lora_path = folder_paths.get_full_path_or_raise("loras", lora_name)
+
+        cache_key = None
+        use_disk_cache = cache_mode == "RAM + Disk"
+        if cache_mode != "Off":
+            try:
+                cache_key = processed_lora_cache.make_key(
+                    "QuantizedLoraLoader", [lora_path],
+                    (quantization_bits, quantization_iterations, bool(stepwise_quantization), quantization_step_size,
+                     bool(blend_mode), blend_factor, quantization_granularity, group_size, bool(error_report)))
+            except OSError:
+                cache_key = None
+
+        cached = processed_lora_cache.get(cache_key, use_disk_cache) if cache_key is not None else None
+        if cached is None:
+            cached = self._build_quantized_lora(lora_path, quantization_bits, quantization_iterations, stepwise_quantization,
+                                                quantization_step_size, blend_mode, blend_factor, quantization_granularity,
+                                                group_size, quantization_device, error_report)
+            if cached is None:
+                return (model, clip, None, None)
+            if cache_key is not None:
+                processed_lora_cache.put(cache_key, cached[0], cached[1], use_disk_cache)
+        quantized_lora, info = cached
+        lora_metadata = info["metadata"]
+        stepwise_quantization = info["stepwise_quantization"]
 
         if model is not None and clip is not None:
             model_lora, clip_lora = comfy.sd.load_lora_for_models(model, clip, quantized_lora, strength_model, strength_clip)
@@ -181,7 +419,153 @@ class QuantizedLoraLoader:
             self._save_processed_lora(lora=quantized_lora, save_name=save_name, quantization_bits=quantization_bits,
                                       quantization_iterations=quantization_iterations, stepwise_quantization=stepwise_quantization,
                                       quantization_step_size=quantization_step_size,
-                                      blend_mode=blend_mode, blend_factor=blend_factor) 
+                                      blend_mode=blend_mode, blend_factor=blend_factor,
+                                      background_save=background_save,
+                                      quantization_granularity=quantization_granularity, group_size=group_size,
+                                      storage_format=storage_format) 
 
+        if "quantization_report" in info:
+            lora_metadata = dict(lora_metadata or {}, quantization_report=info["quantization_report"])
+            summary = info["quantization_report"]["summary"]
+            print(f"Quantization report: {summary['modules']} modules, overall SNR {summary['overall_snr_db']} dB, "
+                  f"min SNR {summary['min_snr_db']} dB ({summary['worst_module']}), max abs error {summary['max_abs']:.6g}")
         lora_metadata_string = json.dumps(lora_metadata, indent=4) if lora_metadata else "{}"
-        return (model_lora, clip_lora, quantized_lora, lora_metadata_string)
\ No newline at end of file
+        return (model_lora, clip_lora, quantized_lora, lora_metadata_string)
+
+
+class QuantizedLoraBatchConverter:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "input_folder": ("STRING", {"default": ""}),
+                "output_folder": ("STRING", {"default": "quantized"}),
+                "recursive": ("BOOLEAN", {"default": True}),
+                "quantization_bits": ("INT", {"default": 8, "min": 2, "max": 32, "step": 1}),
+                "quantization_iterations": ("INT", {"default": 1, "min": 1, "max": 10, "step": 1}),
+                "stepwise_quantization": ("BOOLEAN", {"default": False}),
+                "quantization_step_size": ("INT", {"default": 2, "min": 2, "max": 16, "step": 1}),
+                "blend_mode": ("BOOLEAN", {"default": False}),
+                "blend_factor": ("FLOAT", {"default": 0.5, "min": -10.0, "max": 10.0, "step": 0.01}),
+                "quantization_granularity": (QUANTIZATION_GRANULARITIES, {"default": "Per Tensor"}),
+                "group_size": ("INT", {"default": 64, "min": 1, "max": 4096, "step": 1}),
+                "storage_format": (["Dequantized", "Packed"], {"default": "Dequantized"}),
+                "error_report": ("BOOLEAN", {"default": False}),
+                "num_workers": ("INT", {"default": 2, "min": 1, "max": 64, "step": 1}),
+            }
+        }
+
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return float("NaN")
+
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("manifest",)
+    FUNCTION = "convert_folder"
+    CATEGORY = "tksw_node"
+    OUTPUT_NODE = True
+
+    def _resolve_folder(self, folder):
+        folder = folder.strip()
+        if os.path.isabs(folder):
+            return os.path.abspath(folder)
+        return os.path.abspath(os.path.join(folder_paths.get_folder_paths("loras")[0], folder))
+
+    def _scan_folder(self, input_dir, output_dir, recursive):
+        extensions = tuple(ext.lower() for ext in folder_paths.supported_pt_extensions)
+        sources = []
+        for root, dirs, files in os.walk(input_dir):
+            dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) != output_dir) if recursive else []
+            for filename in sorted(files):
+                if filename.lower().endswith(extensions) and not filename.startswith("."):
+                    sources.append(os.path.join(root, filename))
+        return sources
+
+    def _read_manifest(self, manifest_path):
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if isinstance(manifest, dict):
+                return manifest
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    def _write_manifest(self, manifest_path, manifest):
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        temp_path = f"{manifest_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(temp_path, manifest_path)
+
+    def convert_folder(self, input_folder, output_folder, recursive, quantization_bits, quantization_iterations,
+                       stepwise_quantization, quantization_step_size, blend_mode, blend_factor, quantization_granularity,
+                       group_size, storage_format, error_report, num_workers):
+        input_dir = self._resolve_folder(input_folder)
+        output_dir = self._resolve_folder(output_folder)
+        if not os.path.isdir(input_dir):
+            raise ValueError(f"Input folder does not exist: {input_dir}")
+
+        params = {
+            "quantization_bits": quantization_bits,
+            "quantization_iterations": quantization_iterations,
+            "stepwise_quantization": stepwise_quantization,
+            "quantization_step_size": quantization_step_size,
+            "blend_mode": blend_mode,
+            "blend_factor": blend_factor,
+            "quantization_granularity": quantization_granularity,
+            "group_size": group_size,
+            "storage_format": storage_format,
+            "error_report": error_report,
+        }
+        manifest_path = os.path.join(output_dir, BATCH_MANIFEST_NAME)
+        manifest = self._read_manifest(manifest_path)
+        manifest["input_folder"] = input_dir
+        entries = manifest.setdefault("files", {})
+
+        jobs = []
+        skipped = 0
+        for source_path in self._scan_folder(input_dir, output_dir, recursive):
+            relative_path = os.path.relpath(source_path, input_dir).replace(os.sep, "/")
+            stat = os.stat(source_path)
+            source_id = [stat.st_mtime_ns, stat.st_size]
+            entry = entries.get(relative_path)
+            if (entry and entry.get("status") == "done" and entry.get("source") == source_id and entry.get("params") == params
+                    and os.path.exists(os.path.join(output_dir, entry.get("output", "")))):
+                skipped += 1
+                continue
+            jobs.append((relative_path, source_path, source_id))
+
+        print(f"[QuantizedLoraBatch] {len(jobs)} files to quantize, {skipped} already done. Output: {output_dir}")
+        failed = 0
+        if jobs:
+            loader = QuantizedLoraLoader()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = {
+                    executor.submit(loader._quantize_file, source_path, os.path.splitext(relative_path)[0], output_dir, **params):
+                        (relative_path, source_id)
+                    for relative_path, source_path, source_id in jobs
+                }
+                for done_count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                    relative_path, source_id = futures[future]
+                    entry = {"source": source_id, "params": params}
+                    try:
+                        result = future.result()
+                        entry["output"] = os.path.relpath(result["output"], output_dir).replace(os.sep, "/")
+                        entry["status"] = "done" if result["saved"] else "error"
+                        if result["report"] is not None:
+                            entry["report"] = result["report"]
+                    except Exception as e:
+                        entry["status"] = "error"
+                        entry["error"] = str(e)
+                    if entry["status"] != "done":
+                        failed += 1
+                    entries[relative_path] = entry
+                    self._write_manifest(manifest_path, manifest)
+                    print(f"[QuantizedLoraBatch] ({done_count}/{len(jobs)}) {relative_path}: {entry['status']}")
+        else:
+            self._write_manifest(manifest_path, manifest)
+
+        print(f"[QuantizedLoraBatch] Finished: {len(jobs) - failed} quantized, {failed} failed, {skipped} skipped. "
+              f"Manifest: {manifest_path}")
+        return (json.dumps(manifest, indent=4),)
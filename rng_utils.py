@@ -0,0 +1,16 @@
+import zlib
+import numpy as np
+
+SEED_MASK = (1 << 64) - 1
+
+
+def node_rng(seed, node_name, stream=0, node_id=None):
+    if node_id is not None:
+        node_name = f"{node_name}#{node_id}"
+    key = np.array([int(seed) & SEED_MASK, zlib.crc32(node_name.encode("utf-8"))], dtype=np.uint64)
+    counter = np.array([0, 0, 0, int(stream) & SEED_MASK], dtype=np.uint64)
+    return np.random.Generator(np.random.Philox(key=key, counter=counter))
+
+
+def node_choice(seed, node_name, candidates, stream=0, node_id=None):
+    return candidates[int(node_rng(seed, node_name, stream, node_id).integers(len(candidates)))]
@@ -1,8 +1,8 @@
 import os
-import random
 import torch
 import hashlib
 import codecs
+from .rng_utils import node_choice
 
 class TextFileSelector:
     def __init__(self):
@@ -148,8 +148,7 @@ class TextFileSelector:
 
 
             if mode == "random":
-                random.seed(seed)
-                chosen_filename = random.choice(effective_candidates)
+                chosen_filename = node_choice(seed, "TextFileSelector", effective_candidates)
                 print(f"[TextFileSelector] Mode: random {'with filter' if is_filtered else ''} (Seed: {seed})")
 
             elif mode == "round-robin":
@@ -180,8 +179,7 @@ class TextFileSelector:
 
             else: 
                 print(f"[TextFileSelector] Warning: Unknown mode '{mode}'. Falling back to random.")
-                random.seed(seed)
-                chosen_filename = random.choice(effective_candidates) 
+                chosen_filename = node_choice(seed, "TextFileSelector", effective_candidates)
 
             if chosen_filename:
                 print(f"[TextFileSelector] Selected file: {chosen_filename}")